@@ -0,0 +1,101 @@
+#!/usr/bin/python
+
+# insert_benchmark.py - Measures how many records per second the
+# GliderNetCDFWriter can insert from synthetic merged glider lines.
+#
+# Usage:
+#   python benchmarks/insert_benchmark.py [-n RECORDS] [-u UNKNOWN_KEYS]
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from glider_netcdf_writer import open_glider_netcdf  # NOQA
+
+KNOWN_KEYS = (
+    'm_depth-m',
+    'm_altitude-m',
+    'm_pitch-rad',
+    'm_roll-rad',
+    'm_heading-rad',
+    'm_gps_lat-lat',
+    'm_gps_lon-lon',
+    'sci_water_temp-degc',
+    'sci_water_cond-s/m',
+    'sci_water_pressure-bar',
+    'sci_bbfl2s_chlor_scaled-ug/l',
+    'sci_bbfl2s_cdom_scaled-ppb',
+    'sci_bbfl2s_bb_scaled-nodim',
+    'sci_oxy3835_oxygen-nodim'
+)
+
+
+def create_lines(count, unknown_keys):
+    """ Creates merged reader style lines.  Real flight and science files
+    carry many sensors that are not in datatypes.json, so each line also
+    gets unknown_keys values that the writer has to skip.
+    """
+
+    lines = []
+    for i in range(count):
+        line = {'timestamp': 1400000000.0 + i}
+        for j, key in enumerate(KNOWN_KEYS):
+            line[key] = float(i + j)
+        for j in range(unknown_keys):
+            line['m_unknown_%d-nodim' % j] = float(j)
+        lines.append(line)
+    return lines
+
+
+def time_inserts(lines, **kwargs):
+    """ Returns the seconds spent inserting lines and closing the file,
+    and the seconds the inserting thread waited for the flush thread
+    """
+
+    fd, output_path = tempfile.mkstemp(suffix='.nc')
+    os.close(fd)
+    try:
+        start = time.time()
+        with open_glider_netcdf(output_path, 'w', **kwargs) as glider_nc:
+            for line in lines:
+                glider_nc.stream_dict_insert(line)
+        return time.time() - start, glider_nc.flush_wait_time
+    finally:
+        os.remove(output_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measures stream_dict_insert records per second.'
+    )
+    parser.add_argument(
+        '-n', '--records', type=int, default=5000,
+        help='Number of records to insert.  Default: 5000'
+    )
+    parser.add_argument(
+        '-u', '--unknown_keys', type=int, default=30,
+        help='Number of values per record that are not in datatypes.json. '
+             'Default: 30'
+    )
+    args = parser.parse_args()
+
+    lines = create_lines(args.records, args.unknown_keys)
+    for label, kwargs in (
+        ('unbuffered', {}),
+        ('buffered', {'BUFFER_ROWS': 1024}),
+        ('background', {'BUFFER_ROWS': 1024, 'FLUSH_QUEUE': 1})
+    ):
+        elapsed, wait_time = time_inserts(lines, **kwargs)
+        print "%-12s %10.0f records/s %8.1f ms blocked" % (
+            label, len(lines) / elapsed, wait_time * 1000
+        )
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+#!/usr/bin/python
+
+# storage_benchmark.py - Measures the write time and file size of
+# synthetic glider profiles for several variable storage policies.
+#
+# Usage:
+#   python benchmarks/storage_benchmark.py [-p PROFILES] [-r ROWS [ROWS ...]]
+#       [-s]
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from glider_netcdf_writer import open_glider_netcdf  # NOQA
+from insert_benchmark import KNOWN_KEYS  # NOQA
+
+# (label, STORAGE, QC_STORAGE) for each measured policy
+POLICIES = (
+    ('netcdf default', {'chunksizes': None}, {'chunksizes': None}),
+    ('writer default', None, None),
+    ('chunks 256', {'chunksizes': 256}, {'chunksizes': 256}),
+    ('chunks 4096', {'chunksizes': 4096}, {'chunksizes': 4096}),
+    ('no shuffle', {'shuffle': False}, None),
+    ('qc shuffle', None, {'shuffle': True}),
+    ('fletcher32', {'fletcher32': True}, {'fletcher32': True}),
+    ('3 digits', {'least_significant_digit': 3}, None),
+    ('1 digit', {'least_significant_digit': 1}, None)
+)
+
+
+def create_profile(rows):
+    """ Creates insert_batch columns that vary like a real profile: smooth
+    sensor values and science values on every other row.
+    """
+
+    random = np.random.RandomState(rows)
+    columns = {'timestamp': 1400000000.0 + np.arange(rows) * 2.0}
+    for j, key in enumerate(KNOWN_KEYS):
+        values = j + np.cumsum(random.normal(0, 0.01, rows))
+        if key.startswith('sci_'):
+            values[1::2] = np.nan
+        columns[key] = values
+    return columns
+
+
+def create_lines(columns):
+    """ Converts profile columns to stream_dict_insert lines without the
+    missing values
+    """
+
+    lines = []
+    for i in range(len(columns['timestamp'])):
+        lines.append(dict(
+            (key, values[i]) for key, values in columns.items()
+            if values[i] == values[i]
+        ))
+    return lines
+
+
+def time_profiles(output_path, profiles, storage, qc_storage, stream):
+    """ Writes every profile to its own file with insert_batch, or one
+    unbuffered stream_dict_insert per row if stream is set.  Returns the
+    seconds spent and the total size of the files.
+    """
+
+    size = 0
+    start = time.time()
+    for i, columns in enumerate(profiles):
+        file_path = os.path.join(output_path, 'profile_%d.nc' % i)
+        with open_glider_netcdf(file_path, 'w', STORAGE=storage,
+                                QC_STORAGE=qc_storage) as glider_nc:
+            if stream:
+                for line in columns:
+                    glider_nc.stream_dict_insert(line)
+            else:
+                glider_nc.insert_batch(columns)
+    elapsed = time.time() - start
+
+    for i in range(len(profiles)):
+        file_path = os.path.join(output_path, 'profile_%d.nc' % i)
+        size += os.path.getsize(file_path)
+        os.remove(file_path)
+    return elapsed, size
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measures profile write time and file size for '
+                    'storage policies.'
+    )
+    parser.add_argument(
+        '-p', '--profiles', type=int, default=20,
+        help='Number of profiles to write per policy.  Default: 20'
+    )
+    parser.add_argument(
+        '-r', '--rows', type=int, nargs='+', default=[250, 1000, 4000],
+        help='Rows per profile.  Default: 250 1000 4000'
+    )
+    parser.add_argument(
+        '-s', '--stream', action='store_true',
+        help='Insert one row at a time like unbuffered real-time appends'
+    )
+    args = parser.parse_args()
+
+    output_path = tempfile.mkdtemp()
+    try:
+        for rows in args.rows:
+            profile = create_profile(rows)
+            if args.stream:
+                profile = create_lines(profile)
+            profiles = [profile] * args.profiles
+            print "%d rows per profile" % (rows)
+            for label, storage, qc_storage in POLICIES:
+                elapsed, size = time_profiles(
+                    output_path, profiles, storage, qc_storage, args.stream
+                )
+                print "  %-16s %8.1f ms/profile %8.1f KB/profile" % (
+                    label,
+                    elapsed * 1000 / args.profiles,
+                    size / 1024.0 / args.profiles
+                )
+    finally:
+        shutil.rmtree(output_path)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -16,12 +16,34 @@ import numpy as np
 from netCDF4 import default_fillvals as NC_FILL_VALUES
 from netCDF4 import Dataset, stringtoarr
 import sys
+import os
+import shutil
 from datetime import datetime
 from os import path
 import json
+import math
+import threading
+import time
+from Queue import Queue
+from collections import namedtuple
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 from glider_utils.ctd import calculate_practical_salinity, calculate_density
 
+from glider_netcdf_writer.checks import (
+    DEFAULT_STANDARD_PATH,
+    ValidationError,
+    check_dataset,
+    list_errors,
+    load_requirements
+)
+from glider_netcdf_writer.qartod import (
+    compile_qartod,
+    context_size,
+    run_tests
+)
+
 
 DEFAULT_GLIDER_BASE = path.join(path.dirname(__file__), "config")
 
@@ -36,18 +58,370 @@ GLIDER_QC = {
     "missing_value": 9
 }
 
-GLIDER_UV_DATATYPE_KEYS = (
-    'time_uv',
-    'm_water_vx-m/s',
-    'm_water_vy-m/s',
-    'lon_uv',
-    'lat_uv'
+# Cached description of how values for one datatype key are written.
+# - datatype: The datatype description from datatypes.json
+# - variable: The netCDF4 Variable for the datatype
+# - status_flag: The netCDF4 Variable for the _qc flags, or None
+# - dimension: The datatype dimension name ('time') or None for scalars
+# - statistics: RunningStatistics kept for the variable, or None
+# - transform: The Transform of the datatype, or None
+InsertPlan = namedtuple(
+    'InsertPlan', [
+        'datatype', 'variable', 'status_flag', 'dimension', 'statistics',
+        'transform'
+    ]
+)
+
+# Variables summarized by update_profile_vars in addition to the
+# global_bound variables
+PROFILE_STATISTICS_NAMES = ('time', 'lat', 'lon')
+
+# Description of a variable calculated from other time variables.
+# - key: The datatypes.json key the result is written to
+# - inputs: Variable names passed to function in order.  May name other
+#           derived variables, which are calculated first.
+# - function: Takes one array per input and returns the result array
+DerivedVariable = namedtuple('DerivedVariable', ['key', 'inputs', 'function'])
+
+# Derived variables by variable name.  Add entries to calculate more.
+DERIVED_VARIABLES = {
+    'salinity': DerivedVariable(
+        'salinity-psu',
+        ('time', 'conductivity', 'temperature', 'pressure'),
+        calculate_practical_salinity
+    ),
+    'density': DerivedVariable(
+        'density-kg/m^3',
+        ('time', 'temperature', 'pressure', 'salinity', 'lat', 'lon'),
+        calculate_density
+    )
+}
+
+
+class RunningStatistics(object):
+    """ Count, sum, minimum and maximum of the values that are not fill
+    values or NaN inserted into a single variable.
+    """
+
+    def __init__(self, count=0, total=0.0,
+                 minimum=float('nan'), maximum=float('nan')):
+        self.count = int(count)
+        self.total = float(total)
+        self.minimum = float(minimum)
+        self.maximum = float(maximum)
+
+    def clear(self):
+        self.__init__()
+
+    def add(self, value):
+        if value is None or value == NC_FILL_VALUES['f8'] or value != value:
+            return
+
+        if self.count == 0:
+            self.minimum = value
+            self.maximum = value
+        elif value < self.minimum:
+            self.minimum = value
+        elif value > self.maximum:
+            self.maximum = value
+        self.count += 1
+        self.total += value
+
+    def update(self, values):
+        """ Adds an array of values that are all valid
+        """
+
+        if len(values) == 0:
+            return
+
+        minimum = float(np.min(values))
+        maximum = float(np.max(values))
+        if self.count == 0:
+            self.minimum = minimum
+            self.maximum = maximum
+        else:
+            self.minimum = min(self.minimum, minimum)
+            self.maximum = max(self.maximum, maximum)
+        self.count += len(values)
+        self.total += float(np.sum(values))
+
+    def remove(self, value):
+        """ Removes a value that was added.  Returns False if the value
+        was the minimum or maximum, which can then only be found again
+        from all of the remaining values.
+        """
+
+        if value is None or value == NC_FILL_VALUES['f8'] or value != value:
+            return True
+
+        self.count -= 1
+        self.total -= value
+        return self.minimum < value < self.maximum
+
+    def mean(self):
+        if self.count == 0:
+            return float('nan')
+        return self.total / self.count
+
+
+class FrozenDict(dict):
+    """ Dictionary that cannot be modified, so that one parsed
+    datatypes.json can be shared by every writer in a process.  Copy it
+    with dict() to get a dictionary that can be modified.
+    """
+
+    def __readonly(self, *args, **kwargs):
+        raise TypeError('Shared datatype descriptions cannot be modified')
+
+    __setitem__ = __delitem__ = __readonly
+    clear = pop = popitem = setdefault = update = __readonly
+
+    def __reduce__(self):
+        return FrozenDict, (dict(self),)
+
+
+def freeze(value):
+    """ Returns a copy of parsed JSON with FrozenDicts instead of
+    dictionaries and tuples instead of lists
+    """
+
+    if isinstance(value, dict):
+        return FrozenDict(
+            (key, freeze(item)) for key, item in value.items()
+        )
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+# Parsed contents of a datatypes.json file with precomputed key indexes.
+# - mtime: Modification time of datatypes.json when it was parsed
+# - datatypes: The datatype descriptions keyed by datatype key
+# - time_keys: Keys of datatypes along the time dimension
+# - global_bound_keys: Keys of datatypes with a global_bound
+# - status_flag_keys: Keys of datatypes with a status_flag (_qc) variable
+# - transforms: Transform of each datatype with a transform, by key
+# - product_keys: Keys of transforms with a function, in the order they
+#                 must be calculated
+# - qartod_tests: Configured QARTOD tests of each datatype by key
+DatatypeRegistry = namedtuple(
+    'DatatypeRegistry', [
+        'mtime', 'datatypes', 'time_keys',
+        'global_bound_keys', 'status_flag_keys', 'transforms',
+        'product_keys', 'qartod_tests'
+    ]
+)
+
+# Storage settings of variables along the time dimension, overridden by
+# the STORAGE writer argument and the "storage" of each datatype.
+# - complevel: zlib compression level, or None for the COMP_LEVEL of the
+#               writer
+# - chunksizes: Rows per chunk, or None for the netCDF library default
+# - shuffle: Apply the HDF5 shuffle filter before compression
+# - fletcher32: Store a checksum of every chunk
+# - chunk_cache: [size in bytes, number of chunk slots, preemption] of the
+#                chunk cache of each variable, or None for the default
+# - least_significant_digit: Round floating point values to this power of
+#                ten (2 keeps hundredths) so that they compress better.
+#                'auto' derives it from the resolution and precision attrs
+#                of the datatype.  Default: None (store values exactly)
+DEFAULT_STORAGE = {
+    'complevel': None,
+    'chunksizes': 1024,
+    'shuffle': True,
+    'fletcher32': False,
+    'chunk_cache': None,
+    'least_significant_digit': None
+}
+
+# Storage settings of the i1 _qc variables, overridden by the QC_STORAGE
+# writer argument and the "storage" of each datatype status_flag.
+DEFAULT_QC_STORAGE = {
+    'complevel': None,
+    'chunksizes': 4096,
+    'shuffle': False,
+    'fletcher32': False,
+    'chunk_cache': None
+}
+
+# Vectorized conversion declared by the "transform" of a datatype.
+# Inserted values become values * scale + offset.  If function is set,
+# the values are not inserted but calculated by function from the
+# inserted values of the inputs keys, before the inputs are transformed.
+# Missing input values are NaN.
+Transform = namedtuple(
+    'Transform', ['scale', 'offset', 'function', 'inputs']
 )
 
+# NumPy functions that transforms may name.  Add entries before opening
+# a writer to make more available.
+TRANSFORM_FUNCTIONS = {
+    'degrees': np.degrees,
+    'radians': np.radians,
+    'add': np.add,
+    'subtract': np.subtract,
+    'multiply': np.multiply,
+    'divide': np.divide,
+    'hypot': np.hypot,
+    'arctan2': np.arctan2,
+    'sqrt': np.sqrt,
+    'log10': np.log10,
+    'exp': np.exp
+}
+
+
+def compile_transforms(datatypes):
+    """ Returns the Transform of each datatype with a "transform" and
+    the keys of the transforms with a function in calculation order.
+    """
+
+    transforms = {}
+    for key, desc in datatypes.items():
+        if 'transform' not in desc:
+            continue
+
+        spec = desc['transform']
+        function = None
+        inputs = ()
+        if 'function' in spec:
+            if spec['function'] not in TRANSFORM_FUNCTIONS:
+                raise ValueError(
+                    'Unknown transform function %s for %s' % (
+                        spec['function'], key
+                    )
+                )
+            if desc.get('dimension') != 'time' or \
+                    len(spec.get('inputs', [])) == 0:
+                raise ValueError(
+                    'Transform function of %s needs the time dimension '
+                    'and inputs' % key
+                )
+            function = TRANSFORM_FUNCTIONS[spec['function']]
+            inputs = tuple(spec['inputs'])
+            for name in inputs:
+                if datatypes.get(name, {}).get('dimension') != 'time':
+                    raise ValueError(
+                        'Transform input %s of %s is not a time '
+                        'datatype' % (name, key)
+                    )
+
+        transforms[key] = Transform(
+            spec.get('scale', 1), spec.get('offset', 0), function, inputs
+        )
+
+    # Calculate products after the products they use
+    product_keys = []
+    remaining = sorted(
+        key for key, transform in transforms.items()
+        if transform.function is not None
+    )
+    while remaining:
+        ready = [
+            key for key in remaining
+            if not any(name in remaining for name in transforms[key].inputs)
+        ]
+        if len(ready) == 0:
+            raise ValueError(
+                'Transform inputs form a cycle: %s' % ', '.join(remaining)
+            )
+        product_keys.extend(ready)
+        remaining = [key for key in remaining if key not in ready]
+
+    return transforms, tuple(product_keys)
+
+
+def find_least_significant_digit(attrs):
+    """ Returns the least_significant_digit that keeps the finer of the
+    resolution and precision attrs, such as 3 for '0.001' or -1 for
+    '10 m'.  Returns None if neither attr starts with a positive number.
+    """
+
+    steps = []
+    for name in ('resolution', 'precision'):
+        try:
+            step = float(unicode(attrs.get(name, '')).split()[0])
+        except (ValueError, IndexError):
+            continue
+        if step > 0:
+            steps.append(step)
+
+    if len(steps) == 0:
+        return None
+    return int(math.ceil(round(-math.log10(min(steps)), 6)))
+
+DATATYPE_REGISTRIES = {}
+DATATYPE_REGISTRIES_LOCK = threading.Lock()
+
+# Threads that run QARTOD tests, shared by every writer in the process.
+# Starting and joining a pool for each file costs about 0.1 s in Python 2.
+QARTOD_POOL = {}
+QARTOD_POOL_LOCK = threading.Lock()
+
+
+def get_qartod_pool():
+    """ Returns the shared QARTOD thread pool of this process.  A forked
+    child process gets a new pool because threads do not survive fork.
+    """
+
+    with QARTOD_POOL_LOCK:
+        if QARTOD_POOL.get('pid') != os.getpid():
+            QARTOD_POOL['pid'] = os.getpid()
+            QARTOD_POOL['pool'] = ThreadPool(cpu_count())
+        return QARTOD_POOL['pool']
+
+
+def load_datatype_registry(config_path=DEFAULT_GLIDER_BASE):
+    """ Returns the DatatypeRegistry for config_path/datatypes.json
+
+    Registries are shared by every writer in the process and are only
+    parsed again when datatypes.json is modified.  Their datatype
+    descriptions are FrozenDicts, which raise TypeError when modified.
+    """
+
+    datatypes_path = path.join(config_path, 'datatypes.json')
+    mtime = path.getmtime(datatypes_path)
+
+    with DATATYPE_REGISTRIES_LOCK:
+        registry = DATATYPE_REGISTRIES.get(config_path)
+        if registry is not None and registry.mtime == mtime:
+            return registry
+
+        with open(datatypes_path, 'r') as f:
+            contents = f.read()
+        datatypes = freeze(json.loads(contents))
+
+        registry = DatatypeRegistry(
+            mtime,
+            datatypes,
+            frozenset(
+                key for key, desc in datatypes.items()
+                if desc.get('dimension') == 'time'
+            ),
+            frozenset(
+                key for key, desc in datatypes.items()
+                if 'global_bound' in desc
+            ),
+            frozenset(
+                key for key, desc in datatypes.items()
+                if 'status_flag' in desc
+            ),
+            *(compile_transforms(datatypes) + (compile_qartod(datatypes),))
+        )
+        DATATYPE_REGISTRIES[config_path] = registry
+
+    return registry
+
 
 def open_glider_netcdf(output_path, mode='w', COMP_LEVEL=1,
-                       config_path=DEFAULT_GLIDER_BASE, DEBUG=False):
-    return GliderNetCDFWriter(output_path, mode, COMP_LEVEL, config_path)
+                       config_path=DEFAULT_GLIDER_BASE, DEBUG=False,
+                       BUFFER_ROWS=0, BUFFER_BYTES=0, DISKLESS=False,
+                       VALIDATE=None, STANDARD_PATH=DEFAULT_STANDARD_PATH,
+                       STORAGE=None, QC_STORAGE=None, STORAGE_POLICY=None,
+                       TEMPLATE=None, FLUSH_QUEUE=0):
+    return GliderNetCDFWriter(
+        output_path, mode, COMP_LEVEL, config_path, DEBUG,
+        BUFFER_ROWS, BUFFER_BYTES, DISKLESS, VALIDATE, STANDARD_PATH,
+        STORAGE, QC_STORAGE, STORAGE_POLICY, TEMPLATE, FLUSH_QUEUE
+    )
 
 
 class GliderNetCDFWriter(object):
@@ -56,7 +430,11 @@ class GliderNetCDFWriter(object):
     """
 
     def __init__(self, output_path, mode='w', COMP_LEVEL=1,
-                 config_path=DEFAULT_GLIDER_BASE, DEBUG=False):
+                 config_path=DEFAULT_GLIDER_BASE, DEBUG=False,
+                 BUFFER_ROWS=0, BUFFER_BYTES=0, DISKLESS=False,
+                 VALIDATE=None, STANDARD_PATH=DEFAULT_STANDARD_PATH,
+                 STORAGE=None, QC_STORAGE=None, STORAGE_POLICY=None,
+                 TEMPLATE=None, FLUSH_QUEUE=0):
         """Initializes a Glider NetCDF Writer
         NOTE: Does not open the file.
 
@@ -66,15 +444,104 @@ class GliderNetCDFWriter(object):
                 'a' to append to an existing NetCDF file.
                 Default: 'w'
         - COMP_LEVEL: NetCDF compression level.
+        - BUFFER_ROWS: Buffer stream_dict_insert records in memory and
+                write them to the file every BUFFER_ROWS records.
+                Default: 0 (write every record as it is inserted)
+        - BUFFER_BYTES: Also flush the record buffer once it holds
+                this many bytes.  Default: 0 (no byte threshold)
+        - DISKLESS: Build the file in memory ('w' mode) or in a temporary
+                copy ('a' mode) and rename it over output_path when the
+                with block exits without an error.  Readers never see
+                a partially written file.  With a TEMPLATE, 'w' files
+                are built in a temporary file on disk instead.
+                Default: False
+        - VALIDATE: Check the open file against STANDARD_PATH with the
+                check_glider_netcdf.py tests when the with block exits.
+                'raise' closes and removes the file ('w' or DISKLESS mode)
+                and raises checks.ValidationError if any test fails.
+                'tag' writes the file with the error messages in the
+                validation_errors global attribute.
+                Default: None (no validation)
+        - STANDARD_PATH: Path to the standard requirements JSON file.
+                Default: config/glider_DAC-2.0.json
+        - STORAGE: Dictionary of storage settings for new variables that
+                replace those in DEFAULT_STORAGE.  Settings in the
+                "storage" of a datatype take precedence.  Default: None
+        - QC_STORAGE: Same as STORAGE for _qc variables, replacing
+                DEFAULT_QC_STORAGE.  Default: None
+        - STORAGE_POLICY: Dictionary of storage settings by variable
+                name, such as those written by tune_glider_storage.py.
+                They take precedence over the "storage" of datatypes.
+                Default: None
+        - TEMPLATE: Contents of a NetCDF file with no records, such as
+                those returned by processing.get_header_template.  In 'w'
+                mode the new file starts as a copy of it, so its
+                attributes and variables are not defined again.
+                Default: None
+        - FLUSH_QUEUE: Write full record buffers of a buffered writer in
+                a background thread, while stream_dict_insert fills the
+                next buffer.  At most FLUSH_QUEUE full buffers wait for
+                the thread before stream_dict_insert blocks.  flush
+                waits for every buffer to be written.  An error in the
+                thread is raised by the next flush or stream_dict_insert,
+                or when the with block exits.  Call flush before using
+                nc directly while inserting.
+                Default: 0 (flush in the inserting thread)
         """
 
+        if VALIDATE not in (None, 'raise', 'tag'):
+            raise ValueError('Unknown VALIDATE mode %s' % VALIDATE)
+
         self.nc = None
         self.output_path = output_path
         self.mode = mode
         self.COMP_LEVEL = COMP_LEVEL
         self.config_path = config_path
         self.DEBUG = DEBUG
+        self.BUFFER_ROWS = BUFFER_ROWS
+        self.BUFFER_BYTES = BUFFER_BYTES
+        self.DISKLESS = DISKLESS
+        self.VALIDATE = VALIDATE
+        self.STANDARD_PATH = STANDARD_PATH
+        self.validation_results = None
+        self.STORAGE = dict(DEFAULT_STORAGE, **(STORAGE or {}))
+        self.QC_STORAGE = dict(DEFAULT_QC_STORAGE, **(QC_STORAGE or {}))
+        self.STORAGE_POLICY = STORAGE_POLICY or {}
+        self.TEMPLATE = TEMPLATE
+        self.FLUSH_QUEUE = FLUSH_QUEUE
+        self.flush_queue = None
+        self.flush_thread = None
+        self.flush_error = None
+        # Seconds the inserting thread waited for the flush thread, and
+        # seconds the flush thread spent writing
+        self.flush_wait_time = 0.0
+        self.flush_write_time = 0.0
+        self.temp_path = None
         self.datatypes = {}
+        self.insert_plans = {}
+        self.statistics_names = set()
+        self.running_statistics = {}
+        self.stale_statistics = set()
+        self.start_index = 0
+        self.qartod_start = 0
+        self.column_cache = {}
+        self.__reset_buffer()
+
+    def __reset_buffer(self):
+        """ Internal function that empties the record buffer
+        """
+
+        self.buffer_columns = {}
+        self.buffer_start = None
+        self.buffer_len = 0
+        self.buffer_row_bytes = 0
+        if self.BUFFER_ROWS > 0:
+            self.buffer_capacity = self.BUFFER_ROWS
+        else:
+            self.buffer_capacity = 1024
+
+    def is_buffered(self):
+        return self.BUFFER_ROWS > 0 or self.BUFFER_BYTES > 0
 
     def __setup_qaqc(self):
         """ Internal function for qaqc variable setup
@@ -85,22 +552,18 @@ class GliderNetCDFWriter(object):
         # Meanings of QC_FLAGS
         self.QC_FLAG_MEANINGS = "no_qc_performed good_data probably_good_data bad_data_that_are_potentially_correctable bad_data value_changed not_used not_used interpolated_value missing_value"  # NOQA
 
+        # Maps datatype keys to functions that take a NumPy array of
+        # values and return an equal length array of GLIDER_QC flags
         self.qaqc_methods = {}
 
     def __load_datatypes(self):
         """ Internal function to setup known datatypes
 
-            Adds variables from base_variables.json
+            Uses the shared registry for datatypes.json
         """
 
-        datatypes_path = path.join(
-            self.config_path,
-            'datatypes.json'
-        )
-
-        with open(datatypes_path, 'r') as f:
-            contents = f.read()
-        self.datatypes = json.loads(contents)
+        self.datatype_registry = load_datatype_registry(self.config_path)
+        self.datatypes = self.datatype_registry.datatypes
 
     def __update_history(self):
         """ Updates the history, date_created, date_modified
@@ -123,6 +586,66 @@ class GliderNetCDFWriter(object):
         self.nc.setncattr("date_modified", time_string)
         self.nc.setncattr("date_issued", time_string)
 
+    def __load_running_statistics(self):
+        """ Internal function that sets up the RunningStatistics for the
+        global_bound and profile variables.  Statistics are not stored in
+        the file.  Values written before this open are summarized from the
+        file when the variable is first written or its statistics are
+        first needed.
+        """
+
+        self.statistics_names = set(PROFILE_STATISTICS_NAMES)
+        for key in self.datatype_registry.global_bound_keys:
+            self.statistics_names.add(self.datatypes[key]['name'])
+
+        self.running_statistics = {}
+        self.stale_statistics = set()
+
+    def __read_unmasked(self, variable, index):
+        """ Internal function that reads values with fill values instead
+        of a mask.  Values outside valid_min and valid_max are kept, as
+        they are by the running statistics.
+        """
+
+        auto_mask = variable.mask
+        variable.set_auto_mask(False)
+        try:
+            return variable[index]
+        finally:
+            variable.set_auto_mask(auto_mask)
+
+    def __summarize_variable(self, name, statistics, end=None):
+        """ Internal function that replaces statistics with those of the
+        values of a variable in the file up to end
+        """
+
+        statistics.clear()
+        if name in self.nc.variables and end != 0:
+            values = self.__read_unmasked(
+                self.nc.variables[name], slice(None, end)
+            )
+            statistics.update(values[~self.__missing_values(values)])
+        return statistics
+
+    def get_running_statistics(self, name):
+        """ Returns the RunningStatistics for a variable name.  Variables
+        that were not written through an insert plan, or that had a value
+        replaced, are summarized from the file.
+        """
+
+        if name not in self.statistics_names:
+            raise KeyError('No running statistics kept for %s' % name)
+
+        statistics = self.running_statistics.get(name)
+        if statistics is None or name in self.stale_statistics:
+            self.flush()
+            statistics = self.__summarize_variable(
+                name, statistics or RunningStatistics()
+            )
+            self.running_statistics[name] = statistics
+            self.stale_statistics.discard(name)
+        return statistics
+
     def __get_time_len(self):
         if 'time' in self.nc.variables:
             return len(self.nc.variables['time'])
@@ -135,28 +658,154 @@ class GliderNetCDFWriter(object):
         Called at beginning of Python with block.
         """
 
-        self.nc = Dataset(
-            self.output_path, self.mode,
-            format='NETCDF4_CLASSIC'
-        )
+        if self.TEMPLATE is not None and self.mode == 'w':
+            self.nc = self.__open_template()
+        elif self.DISKLESS:
+            self.nc = self.__open_diskless()
+        else:
+            self.nc = Dataset(
+                self.output_path, self.mode,
+                format='NETCDF4_CLASSIC'
+            )
 
         self.__setup_qaqc()
         self.__load_datatypes()
+        self.insert_plans = {}
+        self.column_cache = {}
+        self.__load_running_statistics()
 
         self.__update_history()
-        self.stream_index = self.__get_time_len()
+        self.start_index = self.__get_time_len()
+        self.stream_index = self.start_index
+        self.qartod_start = self.start_index
+
+        if self.FLUSH_QUEUE > 0 and self.is_buffered():
+            self.__start_flush_thread()
 
         return self
 
     def __exit__(self, type, value, tb):
-        """ Updates bounds and closes file.  Called at end of "with" block
+        """ Flushes buffered records, updates bounds, validates and
+        closes file.  Publishes DISKLESS files.  Called at end of "with"
+        block
         """
 
-        if self.__get_time_len() > 0:
-            self.update_bounds()
+        # Errors while closing are handled like an error in the with block
+        close_error = None
+        try:
+            self.flush()
+        except Exception:
+            if type is None:
+                close_error = sys.exc_info()
+                type, value, tb = close_error
+        finally:
+            self.__stop_flush_thread()
+
+        errors = []
+        try:
+            if self.__get_time_len() > 0:
+                if type is None:
+                    self.run_qartod()
+                self.update_bounds()
+
+            if type is None and self.VALIDATE is not None:
+                errors = self.validate()
+                if self.VALIDATE == 'tag':
+                    if len(errors) > 0:
+                        self.nc.setncattr(
+                            'validation_errors', '\n'.join(errors)
+                        )
+                    elif 'validation_errors' in self.nc.ncattrs():
+                        self.nc.delncattr('validation_errors')
+        except Exception:
+            if type is None:
+                close_error = sys.exc_info()
+                type, value, tb = close_error
+        finally:
+            self.nc.close()
+            self.nc = None
+            self.insert_plans = {}
+            self.column_cache = {}
+        rejected = len(errors) > 0 and self.VALIDATE == 'raise'
+
+        if self.temp_path is not None:
+            if type is None and not rejected:
+                os.rename(self.temp_path, self.output_path)
+            else:
+                os.remove(self.temp_path)
+            self.temp_path = None
+        elif rejected and self.mode == 'w':
+            os.remove(self.output_path)
+
+        if close_error is not None:
+            raise close_error[0], close_error[1], close_error[2]
+
+        if rejected:
+            raise ValidationError(
+                '%s does not meet %s: %s' % (
+                    self.output_path,
+                    path.basename(self.STANDARD_PATH),
+                    '; '.join(errors)
+                ),
+                self.validation_results
+            )
 
-        self.nc.close()
-        self.nc = None
+    def validate(self):
+        """ Runs the check_glider_netcdf.py tests against the open file.
+        Stores the results by test name in validation_results and returns
+        the list of error messages.
+        """
+
+        requirements, standard_hash = load_requirements(self.STANDARD_PATH)
+        self.validation_results = check_dataset(self.nc, requirements)
+        return list_errors(self.validation_results)
+
+    def __open_diskless(self):
+        """ Internal function that opens the Dataset for DISKLESS mode
+
+        New files are built in memory and written to a temporary path in
+        one pass on close.  Existing files are appended in a temporary copy.
+        __exit__ renames the temporary file over output_path.
+        """
+
+        self.temp_path = "%s.%d.tmp" % (self.output_path, os.getpid())
+        if self.mode == 'w':
+            return Dataset(
+                self.temp_path, self.mode,
+                format='NETCDF4_CLASSIC',
+                diskless=True,
+                persist=True
+            )
+
+        shutil.copy(self.output_path, self.temp_path)
+        return Dataset(
+            self.temp_path, self.mode,
+            format='NETCDF4_CLASSIC'
+        )
+
+    def __open_template(self):
+        """ Internal function that starts a new file as a copy of
+        TEMPLATE.  DISKLESS files are written to a temporary path.
+
+        netCDF 4.6 cannot open existing contents for writing in memory:
+        memory= only reads, and a diskless 'a' Dataset does not persist
+        its changes.  So DISKLESS files built from a template are written
+        to disk and only keep the atomic rename on close.
+        """
+
+        file_path = self.output_path
+        if self.DISKLESS:
+            self.temp_path = "%s.%d.tmp" % (self.output_path, os.getpid())
+            file_path = self.temp_path
+
+        with open(file_path, 'wb') as f:
+            f.write(self.TEMPLATE)
+        nc = Dataset(file_path, 'a', format='NETCDF4_CLASSIC')
+
+        # The history of the template is not the history of this file
+        if 'history' in nc.ncattrs():
+            nc.delncattr('history')
+        return nc
 
     def set_global_attributes(self, global_attributes):
         """ Sets a dictionary of values as global attributes
@@ -212,7 +861,8 @@ class GliderNetCDFWriter(object):
                 'S1',
                 ('traj_strlen',),
                 zlib=True,
-                complevel=self.COMP_LEVEL
+                complevel=self.COMP_LEVEL,
+                fletcher32=self.STORAGE['fletcher32']
             )
 
             attrs = {
@@ -238,6 +888,68 @@ class GliderNetCDFWriter(object):
 
         return datatype
 
+    def __compile_insert_plan(self, key):
+        """ Internal function that creates and caches the InsertPlan for
+        a datatype key.  Caches None for keys not in datatypes.json.
+        """
+
+        plan = None
+        if key in self.datatypes:
+            # Variables are created while the flush thread is idle
+            self.__wait_for_flushes()
+            datatype = self.check_datatype_exists(key)
+            status_flag = None
+            if "status_flag" in datatype:
+                status_flag = self.nc.variables[
+                    self.get_status_flag_name(datatype['name'])
+                ]
+            self.__set_chunk_cache(
+                self.nc.variables[datatype['name']],
+                self.get_storage(datatype)
+            )
+            if status_flag is not None:
+                self.__set_chunk_cache(
+                    status_flag, self.get_storage(datatype, qc=True)
+                )
+            statistics = None
+            name = datatype['name']
+            if name in self.statistics_names:
+                statistics = self.running_statistics.get(name)
+                if statistics is None:
+                    # Only values from before this open can be in the file
+                    statistics = self.__summarize_variable(
+                        name, RunningStatistics(), self.start_index
+                    )
+                    self.running_statistics[name] = statistics
+            plan = InsertPlan(
+                datatype,
+                self.nc.variables[datatype['name']],
+                status_flag,
+                datatype['dimension'],
+                statistics,
+                self.datatype_registry.transforms.get(key)
+            )
+        elif self.DEBUG:
+            print 'Unknown datatype %s will not be inserted to NetCDF' % key
+
+        self.insert_plans[key] = plan
+        return plan
+
+    def get_insert_plan(self, key):
+        """ Returns the InsertPlan for a datatype key, creating its
+        variables on first use.  Raises KeyError for unknown datatypes.
+        """
+
+        if key in self.insert_plans:
+            plan = self.insert_plans[key]
+        else:
+            plan = self.__compile_insert_plan(key)
+
+        if plan is None:
+            raise KeyError('Unknown datatype %s cannot '
+                           'be inserted to NetCDF' % key)
+        return plan
+
     def get_status_flag_name(self, name):
         return name + "_qc"
 
@@ -264,8 +976,10 @@ class GliderNetCDFWriter(object):
             desc['type'],
             dimensions=dimension,
             zlib=True,
-            complevel=self.COMP_LEVEL,
-            fill_value=NC_FILL_VALUES[desc['type']]
+            fill_value=NC_FILL_VALUES[desc['type']],
+            **self.__storage_arguments(
+                self.get_storage(desc), dimension, desc
+            )
         )
 
         for k, v in sorted(desc['attrs'].items()):
@@ -280,66 +994,277 @@ class GliderNetCDFWriter(object):
                 'i1',
                 dimension,
                 zlib=True,
-                complevel=self.COMP_LEVEL,
-                fill_value=NC_FILL_VALUES['i1']
+                fill_value=NC_FILL_VALUES['i1'],
+                **self.__storage_arguments(
+                    self.get_storage(desc, qc=True), dimension
+                )
             )
-            # Append defaults
+            # Append defaults without changing the shared description
             sf_standard_name = desc['attrs']['standard_name'] + ' status_flag'
-            status_flag['attrs'].update({
+            status_flag_attrs = dict(status_flag['attrs'])
+            status_flag_attrs.update({
                 'standard_name': sf_standard_name,
                 'flag_meanings': self.QC_FLAG_MEANINGS,
                 'valid_min': self.QC_FLAGS[0],
                 'valid_max': self.QC_FLAGS[-1],
                 'flag_values': self.QC_FLAGS
             })
-            for key, value in sorted(status_flag['attrs'].items()):
+            for key, value in sorted(status_flag_attrs.items()):
                 status_flag_var.setncattr(key, value)
 
+    def get_storage(self, desc, qc=False):
+        """ Returns the storage settings for the variable of a datatype
+        description, or for its _qc variable if qc is True
+        """
+
+        if qc:
+            name = self.get_status_flag_name(desc['name'])
+            storage = dict(self.QC_STORAGE)
+            storage.update(desc['status_flag'].get('storage', {}))
+        else:
+            name = desc['name']
+            storage = dict(self.STORAGE)
+            storage.update(desc.get('storage', {}))
+        storage.update(self.STORAGE_POLICY.get(name, {}))
+        return storage
+
+    def __storage_arguments(self, storage, dimension, desc=None):
+        """ Internal function that converts storage settings to
+        createVariable arguments.  Scalars are not chunked.  Only the
+        floating point variables of desc are quantized.
+        """
+
+        complevel = storage['complevel']
+        if complevel is None:
+            complevel = self.COMP_LEVEL
+
+        arguments = {
+            'complevel': complevel,
+            'shuffle': storage['shuffle'],
+            'fletcher32': storage['fletcher32']
+        }
+        chunksizes = storage['chunksizes']
+        if len(dimension) > 0 and chunksizes is not None:
+            if isinstance(chunksizes, int):
+                chunksizes = [chunksizes]
+            arguments['chunksizes'] = tuple(chunksizes)
+
+        digit = storage.get('least_significant_digit')
+        if digit == 'auto':
+            digit = find_least_significant_digit(desc['attrs'])
+        elif digit is not None and not isinstance(digit, int):
+            raise ValueError(
+                'Unknown least_significant_digit %s for %s' % (
+                    digit, desc['name']
+                )
+            )
+        if digit is not None and desc['type'] in ('f4', 'f8'):
+            arguments['least_significant_digit'] = digit
+        return arguments
+
+    def __set_chunk_cache(self, variable, storage):
+        """ Internal function that sizes the chunk cache of a variable.
+        The chunk cache is not stored in the file, so it is set every
+        time a variable is first used after opening.
+        """
+
+        if storage['chunk_cache'] is not None and variable.dimensions:
+            size, nelems, preemption = storage['chunk_cache']
+            variable.set_var_chunk_cache(size, nelems, preemption)
+
     def perform_qaqc(self, key, value):
         if key in self.qaqc_methods:
-            flag = self.qaqc_methods[key](value)
-        elif value == NC_FILL_VALUES['f8']:
+            flag = self.perform_array_qaqc(key, np.array([value]))[0]
+        elif value == NC_FILL_VALUES['f8'] or value != value:
             flag = GLIDER_QC["missing_value"]
         else:
             flag = GLIDER_QC['no_qc_performed']
 
         return flag
 
+    def perform_array_qaqc(self, key, values):
+        """ Calculates the GLIDER_QC flags for an array of values
+
+        Uses the qaqc_methods function registered for key if there is one.
+        Otherwise, fill values and NaNs are flagged as missing_value and
+        everything else as no_qc_performed.
+        """
+
+        if key in self.qaqc_methods:
+            return np.array(self.qaqc_methods[key](values), 'i1')
+
+        missing = self.__missing_values(values)
+        flags = np.empty(missing.shape, 'i1')
+        flags.fill(GLIDER_QC['no_qc_performed'])
+        flags[missing] = GLIDER_QC['missing_value']
+        return flags
+
+    def __missing_values(self, values):
+        """ Internal function that returns a boolean array that is True
+        wherever values is masked, a fill value or NaN
+        """
+
+        data = np.asarray(values)
+        missing = np.ma.getmaskarray(values) | (data == NC_FILL_VALUES['f8'])
+        if data.dtype.kind == 'f':
+            missing |= np.isnan(data)
+        return missing
+
     def set_scalar(self, key, value=None):
-        datatype = self.check_datatype_exists(key)
+        self.__wait_for_flushes()
+        plan = self.get_insert_plan(key)
 
         if value is None:
-            value = NC_FILL_VALUES[datatype['type']]
+            value = NC_FILL_VALUES[plan.datatype['type']]
 
-        self.nc.variables[datatype['name']].assignValue(value)
+        plan.variable.assignValue(value)
 
-        if "status_flag" in datatype:
-            status_flag_name = self.get_status_flag_name(datatype['name'])
-            flag = self.perform_qaqc(key, value)
-            self.nc.variables[status_flag_name].assignValue(flag)
+        if plan.status_flag is not None:
+            plan.status_flag.assignValue(self.perform_qaqc(key, value))
 
     def set_array_value(self, key, index, value=None):
-        datatype = self.check_datatype_exists(key)
+        # Buffered rows would otherwise replace the value when flushed
+        self.flush()
+        self.column_cache.clear()
+        plan = self.get_insert_plan(key)
+        if plan.statistics is not None and index < len(plan.variable):
+            replaced = self.__read_unmasked(plan.variable, index)
+            if not plan.statistics.remove(float(replaced)):
+                self.stale_statistics.add(plan.datatype['name'])
+        if plan.dimension == 'time':
+            self.qartod_start = min(self.qartod_start, index)
+        self.__set_plan_value(plan, key, index, value)
+
+    def __set_plan_value(self, plan, key, index, value=None):
+        """ Internal function that writes one value through an InsertPlan
+        """
 
         if value is None:
-            value = NC_FILL_VALUES[datatype['type']]
+            value = NC_FILL_VALUES[plan.datatype['type']]
 
-        self.nc.variables[datatype['name']][index] = value
+        plan.variable[index] = value
 
-        if "status_flag" in datatype:
-            status_flag_name = self.get_status_flag_name(datatype['name'])
-            flag = self.perform_qaqc(key, value)
-            self.nc.variables[status_flag_name][index] = flag
+        if plan.statistics is not None:
+            plan.statistics.add(value)
+
+        if plan.status_flag is not None:
+            plan.status_flag[index] = self.perform_qaqc(key, value)
 
     def set_array(self, key, values):
-        datatype = self.check_datatype_exists(key)
+        self.flush()
+        plan = self.get_insert_plan(key)
+
+        plan.variable[:] = values
+        self.__cache_column(plan, values)
+        if plan.dimension == 'time':
+            self.qartod_start = 0
+        if plan.statistics is not None:
+            # Every value in the variable was replaced
+            plan.statistics.clear()
+            plan.statistics.update(
+                np.asarray(values)[~self.__missing_values(values)]
+            )
+            self.stale_statistics.discard(plan.datatype['name'])
+        if plan.status_flag is not None:
+            plan.status_flag[:] = self.perform_array_qaqc(key, values)
+
+    def __cache_column(self, plan, values):
+        """ Internal function that keeps a reference to the values of a
+        whole time variable for calculate_derived
+        """
+
+        name = plan.datatype['name']
+        if plan.dimension == 'time' and not np.ma.isMaskedArray(values):
+            self.column_cache[name] = np.asarray(values)
+        else:
+            self.column_cache.pop(name, None)
+
+    def get_column(self, name):
+        """ Returns all values of a time variable as a NumPy array, with
+        fill values where values are missing.  Values written by
+        insert_batch or set_array are returned from memory.  Others are
+        read from the file once and kept until the next stream insert.
+        """
+
+        self.__wait_for_flushes()
+        column = self.column_cache.get(name)
+        if column is None or len(column) != self.__get_time_len():
+            column = np.array(self.nc.variables[name][:])
+            self.column_cache[name] = column
+        return column
+
+    def run_qartod(self):
+        """ Runs the QARTOD tests configured in datatypes.json over the
+        rows of each tested variable written since the file was opened
+        and writes the combined flags to its _qc variable.  Earlier rows
+        are read only as far as tests that compare neighbors need them.
+        Variables are tested in parallel threads.  Keys with a
+        qaqc_methods function are not tested.  Missing values keep their
+        flags.  Called by __exit__.
+        """
+
+        self.flush()
+
+        qartod_tests = self.datatype_registry.qartod_tests
+        keys = sorted(
+            key for key in qartod_tests
+            if key not in self.qaqc_methods and self.contains(key)
+        )
+        start = self.qartod_start
+        end = self.__get_time_len()
+        if len(keys) == 0 or start >= end:
+            return
+
+        columns = [
+            (key,) + self.__read_qartod_rows(
+                self.datatypes[key]['name'], start, end,
+                context_size(qartod_tests[key])
+            )
+            for key in keys
+        ]
+
+        def test_column(column):
+            key, first, times, values = column
+            valid = ~(self.__missing_values(values) |
+                      self.__missing_values(times))
+            flags = run_tests(
+                values[valid], times[valid], qartod_tests[key]
+            )
+            # Earlier rows are only read for context and keep their flags
+            context = np.count_nonzero(valid[:start - first])
+            return valid[start - first:], flags[context:]
+
+        if len(columns) > 1:
+            results = get_qartod_pool().map(test_column, columns)
+        else:
+            results = map(test_column, columns)
+
+        # netCDF4 is not thread safe, so flags are written here
+        for key, (valid, flags) in zip(keys, results):
+            status_flag = self.get_insert_plan(key).status_flag
+            qc = status_flag[start:end]
+            qc[valid] = flags
+            status_flag[start:end] = qc
+
+    def __read_qartod_rows(self, name, start, end, context):
+        """ Internal function that returns the first row read and the
+        times and values of a variable from that row to end.  Rows before
+        start are read until context of them have a time and a value.
+        """
+
+        if start == 0:
+            return 0, self.get_column('time'), self.get_column(name)
 
-        self.nc.variables[datatype['name']][:] = values
-        if "status_flag" in datatype:
-            status_flag_name = self.get_status_flag_name(datatype['name'])
-            for i, value in enumerate(values):
-                flag = self.perform_qaqc(key, value)
-                self.nc.variables[status_flag_name][i] = flag
+        window = context
+        while True:
+            first = max(0, start - window)
+            times = np.array(self.nc.variables['time'][first:end])
+            values = np.array(self.nc.variables[name][first:end])
+            earlier = ~(self.__missing_values(values[:start - first]) |
+                        self.__missing_values(times[:start - first]))
+            if first == 0 or np.count_nonzero(earlier) >= context:
+                return first, times, values
+            window *= 2
 
     def set_segment_id(self, segment_id):
         """ Sets the segment ID as a variable
@@ -393,6 +1318,266 @@ class GliderNetCDFWriter(object):
                 description['attrs']
             )
 
+    def __buffer_plan_value(self, plan, key, index, value=None):
+        """ Internal function that stores a value in the record buffer
+        instead of writing it to the file.  Same inputs as __set_plan_value.
+        """
+
+        datatype = plan.datatype
+
+        if value is None:
+            value = NC_FILL_VALUES[datatype['type']]
+
+        if self.buffer_start is None:
+            self.buffer_start = index
+        row = index - self.buffer_start
+
+        if row >= self.buffer_capacity:
+            self.__grow_buffer(row + 1)
+
+        if key not in self.buffer_columns:
+            data = np.empty(self.buffer_capacity, datatype['type'])
+            data.fill(NC_FILL_VALUES[datatype['type']])
+            self.buffer_row_bytes += data.itemsize
+            present = None
+            if plan.status_flag is not None:
+                present = np.zeros(self.buffer_capacity, bool)
+                self.buffer_row_bytes += present.itemsize
+            self.buffer_columns[key] = [plan, data, present]
+
+        plan, data, present = self.buffer_columns[key]
+        data[row] = value
+        if present is not None:
+            present[row] = True
+
+    def __grow_buffer(self, min_size):
+        """ Internal function that doubles the size of every buffer column
+        until min_size rows fit.  Only used without a BUFFER_ROWS limit.
+        """
+
+        size = max(self.buffer_capacity, 1)
+        while size < min_size:
+            size *= 2
+
+        for column in self.buffer_columns.values():
+            data = np.empty(size, column[1].dtype)
+            data.fill(NC_FILL_VALUES[column[0].datatype['type']])
+            data[:self.buffer_capacity] = column[1]
+            column[1] = data
+            if column[2] is not None:
+                present = np.zeros(size, bool)
+                present[:self.buffer_capacity] = column[2]
+                column[2] = present
+
+        self.buffer_capacity = size
+
+    def flush(self):
+        """ Writes any buffered records to the file with one contiguous
+        write per variable and per status flag variable.  Waits for the
+        flush thread to write every buffer.
+        """
+
+        self.__flush_buffer()
+        self.__wait_for_flushes()
+
+    def __flush_buffer(self):
+        """ Internal function that writes the record buffer, or queues it
+        for the flush thread, and starts a new buffer
+        """
+
+        if self.buffer_len == 0:
+            self.__reset_buffer()
+            return
+
+        self.column_cache.clear()
+        self.__buffer_products()
+
+        batch = (self.buffer_start, self.buffer_len, self.buffer_columns)
+        if self.flush_thread is not None:
+            self.__raise_flush_error()
+            wait_start = time.time()
+            self.flush_queue.put(batch)
+            self.flush_wait_time += time.time() - wait_start
+        else:
+            self.__write_buffer(*batch)
+
+        self.__reset_buffer()
+
+    def __write_buffer(self, start, length, buffer_columns):
+        """ Internal function that writes length buffered records at
+        start with one write per variable
+        """
+
+        end = start + length
+        for key, (plan, data, present) in buffer_columns.items():
+            data = data[:length]
+            if plan.transform is not None:
+                self.__transform_values(
+                    plan, data, self.__missing_values(data)
+                )
+            plan.variable[start:end] = data
+            if plan.statistics is not None:
+                plan.statistics.update(data[~self.__missing_values(data)])
+            if present is not None:
+                # Rows without a value for this key keep the fill flag
+                flags = self.perform_array_qaqc(key, data)
+                flags[~present[:length]] = NC_FILL_VALUES['i1']
+                plan.status_flag[start:end] = flags
+
+    def __start_flush_thread(self):
+        self.flush_queue = Queue(self.FLUSH_QUEUE)
+        self.flush_error = None
+        self.flush_thread = threading.Thread(target=self.__flush_loop)
+        self.flush_thread.daemon = True
+        self.flush_thread.start()
+
+    def __stop_flush_thread(self):
+        if self.flush_thread is None:
+            return
+
+        self.flush_queue.put(None)
+        self.flush_thread.join()
+        self.flush_thread = None
+        self.flush_queue = None
+
+    def __flush_loop(self):
+        """ Internal function that writes queued buffers until it gets
+        None.  Buffers after an error are dropped.
+        """
+
+        while True:
+            batch = self.flush_queue.get()
+            try:
+                if batch is None:
+                    return
+                if self.flush_error is None:
+                    write_start = time.time()
+                    self.__write_buffer(*batch)
+                    self.flush_write_time += time.time() - write_start
+            except Exception:
+                self.flush_error = sys.exc_info()
+            finally:
+                self.flush_queue.task_done()
+
+    def __wait_for_flushes(self):
+        """ Internal function that waits until the flush thread has
+        written every queued buffer, so that the file can be used from
+        this thread
+        """
+
+        if self.flush_thread is None:
+            return
+
+        wait_start = time.time()
+        self.flush_queue.join()
+        self.flush_wait_time += time.time() - wait_start
+        self.__raise_flush_error()
+
+    def __raise_flush_error(self):
+        # Raised again by every later flush, since records are missing
+        if self.flush_error is not None:
+            error = self.flush_error
+            raise error[0], error[1], error[2]
+
+    def __transform_values(self, plan, data, missing):
+        """ Internal function that applies the scale and offset of a
+        plan's Transform to the values of data that are not missing, in
+        place
+        """
+
+        transform = plan.transform
+        if transform.scale != 1 or transform.offset != 0:
+            valid = ~missing
+            data[valid] = data[valid] * transform.scale + transform.offset
+
+    def __transform_value(self, plan, value):
+        """ Internal function that applies the scale and offset of a
+        plan's Transform to one value
+        """
+
+        if value is None or value == NC_FILL_VALUES['f8'] or value != value:
+            return value
+
+        transform = plan.transform
+        return value * transform.scale + transform.offset
+
+    def __add_products(self, keys, columns):
+        """ Internal function that calculates the columns of product
+        datatype keys from the input columns in columns.  Products with
+        missing input columns are skipped.  Missing values are NaN.
+        """
+
+        transforms = self.datatype_registry.transforms
+        for key in keys:
+            transform = transforms[key]
+            if not all(name in columns for name in transform.inputs):
+                continue
+
+            inputs = []
+            for name in transform.inputs:
+                values = columns[name]
+                data = np.array(np.ma.filled(values, np.nan), 'f8')
+                data[self.__missing_values(values)] = np.nan
+                inputs.append(data)
+
+            with np.errstate(all='ignore'):
+                columns[key] = np.asarray(transform.function(*inputs), 'f8')
+
+    def __add_line_products(self, line):
+        """ Internal function that returns a copy of a stream line with
+        the values of the products it has inputs for
+        """
+
+        columns = dict(
+            (name, np.array([line[name]], 'f8'))
+            for key in self.datatype_registry.product_keys
+            for name in self.datatype_registry.transforms[key].inputs
+            if name in line
+        )
+        self.__add_products(self.datatype_registry.product_keys, columns)
+
+        line = dict(line)
+        for key in self.datatype_registry.product_keys:
+            if key in columns and key not in line:
+                value = columns[key][0]
+                if value == value:
+                    line[key] = value
+        return line
+
+    def __buffer_products(self):
+        """ Internal function that calculates product columns from the
+        buffered input columns before a flush.  Rows where the product
+        cannot be calculated are stored like rows without a value.
+        """
+
+        keys = [
+            key for key in self.datatype_registry.product_keys
+            if key not in self.buffer_columns
+        ]
+        if len(keys) == 0:
+            return
+
+        columns = dict(
+            (key, column[1][:self.buffer_len])
+            for key, column in self.buffer_columns.items()
+        )
+        self.__add_products(keys, columns)
+
+        for key in keys:
+            if key not in columns:
+                continue
+
+            plan = self.get_insert_plan(key)
+            values = columns[key]
+            valid = ~np.isnan(values)
+            data = np.empty(self.buffer_len, plan.datatype['type'])
+            data.fill(NC_FILL_VALUES[plan.datatype['type']])
+            data[valid] = values[valid]
+            present = None
+            if plan.status_flag is not None:
+                present = valid
+            self.buffer_columns[key] = [plan, data, present]
+
     def fill_uv_vars(self, line):
         self.set_scalar('time_uv', line['m_present_time-timestamp'])
         self.set_scalar('lat_uv', line['m_gps_lat-lat'])
@@ -405,35 +1590,166 @@ class GliderNetCDFWriter(object):
         - line: A dictionary of values where the key is a given
                 <value name>-<units> pair that matches a description
                 in the datatypes.json file.
+
+        When the writer is buffered, time dimensioned values are held in
+        memory until flush is called or a buffer threshold is reached.
         """
 
         if 'timestamp' not in line:
             print line
             raise ValueError('No timestamp found for line')
 
-        self.set_array_value('timestamp', self.stream_index, line['timestamp'])
+        if self.column_cache:
+            self.column_cache.clear()
 
+        if self.is_buffered():
+            set_plan_value = self.__buffer_plan_value
+        else:
+            set_plan_value = self.__set_plan_value
+
+        set_plan_value(
+            self.get_insert_plan('timestamp'), 'timestamp',
+            self.stream_index, line['timestamp']
+        )
+
+        # Buffered products are calculated for the whole buffer on flush
+        if self.datatype_registry.product_keys and not self.is_buffered():
+            line = self.__add_line_products(line)
+
+        insert_plans = self.insert_plans
         for name, value in line.items():
             if name == 'timestamp':
                 continue  # Skip timestamp, inserted above
 
-            try:
-                datatype = self.check_datatype_exists(name)
-            except KeyError, e:
-                if self.DEBUG:
-                    print e
-                continue
+            if name in insert_plans:
+                plan = insert_plans[name]
+            else:
+                plan = self.__compile_insert_plan(name)
 
-            datatype = self.datatypes[name]
-            if datatype['dimension'] == 'time':
-                self.set_array_value(name, self.stream_index, value)
+            if plan is None:
+                continue  # Not in datatypes.json
+
+            if plan.dimension == 'time':
+                # Buffered values are transformed for the whole buffer
+                if plan.transform is not None and not self.is_buffered():
+                    value = self.__transform_value(plan, value)
+                set_plan_value(plan, name, self.stream_index, value)
             else:
+                if plan.transform is not None:
+                    value = self.__transform_value(plan, value)
                 self.set_scalar(name, value)
                 if name == "m_water_vx-m/s":
                     self.fill_uv_vars(line)
 
         self.stream_index += 1
 
+        if self.is_buffered():
+            self.buffer_len += 1
+            if self.BUFFER_ROWS > 0 and self.buffer_len >= self.BUFFER_ROWS:
+                self.__flush_buffer()
+            elif (self.BUFFER_BYTES > 0 and
+                  self.buffer_len * self.buffer_row_bytes >=
+                  self.BUFFER_BYTES):
+                self.__flush_buffer()
+
+    def insert_batch(self, columns):
+        """ Appends a batch of records to the NetCDF file starting at
+        stream_index, with one write per variable.
+
+        Input:
+        - columns: A dictionary of equal length arrays or a NumPy
+                structured array.  Keys or field names are
+                <value name>-<units> pairs that match a description
+                in the datatypes.json file.  Missing values should be
+                NaN, masked or the NetCDF fill value.  They are stored like
+                fields that are missing from a stream_dict_insert line.
+
+        Scalar datatypes are set to the last value in their column that is
+        not missing.
+        """
+
+        if isinstance(columns, np.ndarray):
+            columns = dict(
+                (name, columns[name]) for name in columns.dtype.names
+            )
+
+        if 'timestamp' not in columns:
+            raise ValueError('No timestamp found for batch')
+
+        length = len(columns['timestamp'])
+        for name, values in columns.items():
+            if len(values) != length:
+                raise ValueError(
+                    'Column %s has %d values, expected %d' % (
+                        name, len(values), length
+                    )
+                )
+
+        if length == 0:
+            return
+
+        self.flush()
+        start = self.stream_index
+        end = start + length
+
+        products = [
+            key for key in self.datatype_registry.product_keys
+            if key not in columns
+        ]
+        if len(products) > 0:
+            columns = dict(columns)
+            self.__add_products(products, columns)
+
+        # timestamp comes first so that the time dimension exists
+        names = sorted(columns.keys(), key=lambda name: name != 'timestamp')
+        for name in names:
+            values = columns[name]
+            if name in self.insert_plans:
+                plan = self.insert_plans[name]
+            else:
+                plan = self.__compile_insert_plan(name)
+
+            if plan is None:
+                continue  # Not in datatypes.json
+
+            missing = self.__missing_values(values)
+            if plan.dimension == 'time':
+                datatype = plan.datatype
+                fill_value = NC_FILL_VALUES[datatype['type']]
+                data = np.array(
+                    np.ma.filled(values, fill_value), datatype['type']
+                )
+                data[missing] = fill_value
+                if plan.transform is not None:
+                    self.__transform_values(plan, data, missing)
+                plan.variable[start:end] = data
+                if start == 0:
+                    self.__cache_column(plan, data)
+                else:
+                    self.column_cache.pop(datatype['name'], None)
+                if plan.statistics is not None:
+                    plan.statistics.update(data[~missing])
+                if plan.status_flag is not None:
+                    flags = self.perform_array_qaqc(name, data)
+                    flags[missing] = NC_FILL_VALUES['i1']
+                    plan.status_flag[start:end] = flags
+            else:
+                valid = np.flatnonzero(~missing)
+                if len(valid) == 0:
+                    continue
+                index = valid[-1]
+                value = values[index]
+                if plan.transform is not None:
+                    value = self.__transform_value(plan, value)
+                self.set_scalar(name, value)
+                if name == "m_water_vx-m/s":
+                    self.fill_uv_vars(dict(
+                        (key, column[index])
+                        for key, column in columns.items()
+                    ))
+
+        self.stream_index = end
+
     def contains(self, datatype_key):
         if datatype_key in self.datatypes:
             field_name = self.datatypes[datatype_key]['name']
@@ -470,122 +1786,129 @@ class GliderNetCDFWriter(object):
             except KeyError, ex:
                 print ex
 
-    def __netcdf_to_np_op(self, variable_data, operation):
-        array = np.array(variable_data)
-        array[array == NC_FILL_VALUES['f8']] = float('nan')
-
-        result = operation(array)
-        if result == np.nan:
-            result = NC_FILL_VALUES['f8']
-        return result
-
     def update_profile_vars(self):
         """ Internal function that updates all profile variables
         before closing a file
+
+        Uses the running statistics of the inserted time, lat and lon
+        values.  Missing values are ignored.
         """
 
+        self.flush()
+
         if 'time' in self.nc.variables:
-            profile_time = self.__netcdf_to_np_op(
-                self.nc.variables['time'][:],
-                np.nanmin
-            )
+            profile_time = self.get_running_statistics('time').minimum
             self.set_scalar('profile_time', profile_time)
 
         if 'lon' in self.nc.variables:
-            profile_lon = self.__netcdf_to_np_op(
-                self.nc.variables['lon'][:],
-                np.average
-            )
+            profile_lon = self.get_running_statistics('lon').mean()
             self.set_scalar('profile_lon', profile_lon)
 
         if 'lat' in self.nc.variables:
-            profile_lat = self.__netcdf_to_np_op(
-                self.nc.variables['lat'][:],
-                np.average
-            )
+            profile_lat = self.get_running_statistics('lat').mean()
             self.set_scalar('profile_lat', profile_lat)
 
     def update_bounds(self):
         """ Internal function that updates all global attribute bounds
-        before closing a file.
-        """
-
-        for key, desc in self.datatypes.items():
-            if 'global_bound' in desc:
-                prefix = desc['global_bound']
-                dataset = self.nc.variables[desc['name']][:]
-                self.nc.setncattr(
-                    prefix + '_min',
-                    self.__netcdf_to_np_op(
-                        dataset,
-                        np.nanmin
-                    )
-                )
-                self.nc.setncattr(
-                    prefix + '_max',
-                    self.__netcdf_to_np_op(
-                        dataset,
-                        np.nanmax
-                    )
-                )
-                self.nc.setncattr(
-                    prefix + '_units',
-                    desc['attrs']['units']
-                )
-                self.nc.setncattr(
-                    prefix + '_resolution',
-                    desc['attrs']['resolution']
-                )
-                self.nc.setncattr(
-                    prefix + '_accuracy',
-                    desc['attrs']['accuracy']
-                )
-                self.nc.setncattr(
-                    prefix + '_precision',
-                    desc['attrs']['precision']
-                )
+        before closing a file.  Bounds of variables that were not written
+        since they were last updated are left as they are.
+        """
 
-    def calculate_salinity(self):
-        if self.__get_time_len() == 0:
-            raise TypeError('Cannot calculate salinity: time array empty')
-
-        required_params = ('time', 'conductivity', 'temperature', 'pressure')
-        for param in required_params:
-            if param not in self.nc.variables:
-                raise TypeError('Cannot calculate salinity: '
-                                'missing %s' % param)
-
-        salinity = calculate_practical_salinity(
-            np.array(self.nc.variables["time"][:]),
-            np.array(self.nc.variables["conductivity"][:]),
-            np.array(self.nc.variables["temperature"][:]),
-            np.array(self.nc.variables["pressure"][:])
-        )
+        for key in self.datatype_registry.global_bound_keys:
+            desc = self.datatypes[key]
+            prefix = desc['global_bound']
+            if desc['name'] not in self.nc.variables:
+                continue
+            if desc['name'] not in self.running_statistics and \
+                    prefix + '_min' in self.nc.ncattrs():
+                continue
+            statistics = self.get_running_statistics(desc['name'])
+            self.nc.setncattr(
+                prefix + '_min',
+                statistics.minimum
+            )
+            self.nc.setncattr(
+                prefix + '_max',
+                statistics.maximum
+            )
+            self.nc.setncattr(
+                prefix + '_units',
+                desc['attrs']['units']
+            )
+            self.nc.setncattr(
+                prefix + '_resolution',
+                desc['attrs']['resolution']
+            )
+            self.nc.setncattr(
+                prefix + '_accuracy',
+                desc['attrs']['accuracy']
+            )
+            self.nc.setncattr(
+                prefix + '_precision',
+                desc['attrs']['precision']
+            )
 
-        salinity[np.isnan(salinity)] = NC_FILL_VALUES['f8']
-        self.set_array('salinity-psu', salinity)
+    def calculate_salinity(self):
+        self.calculate_derived(['salinity'])
 
     def calculate_density(self):
-        if self.__get_time_len() == 0:
-            raise TypeError('Cannot calculate salinity: time array empty')
+        self.calculate_derived(['density'])
 
-        required_params = (
-            'time', 'conductivity', 'temperature', 'pressure',
-            'salinity', 'lat', 'lon'
-        )
-        for param in required_params:
-            if param not in self.nc.variables:
-                raise TypeError('Cannot calculate salinity: '
-                                'missing %s' % param)
-
-        density = calculate_density(
-            np.array(self.nc.variables["time"][:]),
-            np.array(self.nc.variables["temperature"][:]),
-            np.array(self.nc.variables["pressure"][:]),
-            np.array(self.nc.variables["salinity"][:]),
-            np.array(self.nc.variables["lat"][:]),
-            np.array(self.nc.variables["lon"][:])
-        )
+    def calculate_derived(self, names=None):
+        """ Calculates derived variables and writes each with one
+        set_array call
+
+        Input:
+        - names: Names of DERIVED_VARIABLES to calculate.  Derived inputs
+                that are not in the file are calculated first.
+                Default: all DERIVED_VARIABLES in dependency order.
+
+        Each input column is read at most once.  Results are used from
+        memory by the variables that depend on them.  Raises TypeError
+        for the first variable that cannot be calculated.
+        """
+
+        self.flush()
+
+        if names is None:
+            names = sorted(DERIVED_VARIABLES)
+        for name in self.__order_derived(names):
+            derived = DERIVED_VARIABLES[name]
+            if self.__get_time_len() == 0:
+                raise TypeError('Cannot calculate %s: '
+                                'time array empty' % name)
+
+            for param in derived.inputs:
+                if param not in self.nc.variables:
+                    raise TypeError('Cannot calculate %s: '
+                                    'missing %s' % (name, param))
+
+            values = derived.function(
+                *[self.get_column(param) for param in derived.inputs]
+            )
+            values[np.isnan(values)] = NC_FILL_VALUES['f8']
+            self.set_array(derived.key, values)
+
+    def __order_derived(self, names):
+        """ Internal function that lists names after the derived variables
+        they depend on.  Dependencies already in the file are only
+        included if they are in names.
+        """
 
-        density[np.isnan(density)] = NC_FILL_VALUES['f8']
-        self.set_array('density-kg/m^3', density)
+        order = []
+
+        def visit(name, visiting):
+            if name in order:
+                return
+            if name in visiting:
+                raise ValueError('Derived variable %s depends on itself'
+                                 % name)
+            for param in DERIVED_VARIABLES[name].inputs:
+                if param in DERIVED_VARIABLES and \
+                        (param in names or param not in self.nc.variables):
+                    visit(param, visiting + (name,))
+            order.append(name)
+
+        for name in names:
+            visit(name, ())
+        return order
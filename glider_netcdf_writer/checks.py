@@ -0,0 +1,364 @@
+# checks.py - Verifies that a glider NetCDF file contains all the required
+#   global attributes, dimensions, scalar variables and dimensioned
+#   variables of a standard such as glider_DAC-2.0.json.
+#
+# Each test_* function returns a list of error messages.  check_dataset
+# runs all of them against an open Dataset and check_files validates many
+# files in a process pool, skipping files whose results are cached.
+#
+# By: Michael Lindemuth <mlindemu@usf.edu>
+# University of South Florida
+# College of Marine Science
+# Ocean Technology Group
+
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from multiprocessing import Pool
+
+from netCDF4 import Dataset
+
+
+DEFAULT_STANDARD_PATH = os.path.join(
+    os.path.dirname(__file__), 'config', 'glider_DAC-2.0.json'
+)
+
+
+class ValidationError(ValueError):
+    """ Raised when a file does not meet a standard.  results holds the
+    error messages of each test, as returned by check_dataset.
+    """
+
+    def __init__(self, message, results):
+        super(ValidationError, self).__init__(message)
+        self.results = results
+
+    def __reduce__(self):
+        # Worker processes send exceptions back pickled
+        return (ValidationError, (str(self), self.results))
+
+
+def test_global_attributes(nc, requirements):
+    """ Tests for required global attributes
+    """
+    errors = []
+
+    global_attributes = nc.ncattrs()
+    for req_attribute in requirements['global_attributes']:
+        if req_attribute not in global_attributes:
+            errors.append("Global Attribute Missing: %s" % (req_attribute))
+    return errors
+
+
+def test_dimensions(nc, requirements):
+    """ Tests for required dimensions
+    """
+    errors = []
+
+    for req_dimension in requirements['dimensions']:
+        if req_dimension not in nc.dimensions:
+            errors.append("Dimension Missing: %s" % (req_dimension))
+
+    return errors
+
+
+def test_required_variables(nc, requirements):
+    """ Tests for required variables
+    """
+    errors = []
+
+    for req_variable in requirements['required_variables']:
+        variables = nc.variables
+        if req_variable not in variables:
+            errors.append("Missing required variable %s" % req_variable)
+
+    return errors
+
+
+def test_variable_attributes(nc, requirements):
+    """ Tests for required variable attributes
+    """
+    errors = []
+
+    for variable_name in nc.variables:
+        # Skip QC variables
+        if variable_name[-2:] == "qc":
+            continue
+
+        # Ignore configured variables
+        if variable_name in requirements['ignore_variable_check']:
+            continue
+
+        variable = nc.variables[variable_name]
+        # Skip scalar and descriptive variables
+        if variable.size < 2:
+            continue
+
+        var_attrs = nc.variables[variable_name].ncattrs()
+        for req_var_attr in requirements['variable_attributes']:
+            if req_var_attr not in var_attrs:
+                errors.append(
+                    "Variable attribute %s "
+                    "missing in %s variable" % (req_var_attr, variable_name)
+                )
+
+    return errors
+
+
+def test_qc_variables(nc, requirements):
+    """ Tests that all variables have a corresponding qc variable
+    """
+    errors = []
+
+    for variable_name in nc.variables:
+        # Skip QC variables
+        if variable_name[-2:] == "qc":
+            continue
+
+        # Ignore configured variables
+        if variable_name in requirements['ignore_variable_check']:
+            continue
+
+        variable = nc.variables[variable_name]
+        if variable.size < 2:
+            continue
+
+        qc_name = "%s_qc" % variable_name
+        if qc_name not in nc.variables:
+            errors.append("QC variable missing for %s" % variable_name)
+
+    return errors
+
+
+def test_platform_attributes(nc, requirements):
+    """ Tests for required platform attributes
+    """
+    errors = []
+
+    platform_attrs = nc.variables['platform'].ncattrs()
+    for req_platform_attr in requirements['platform_attributes']:
+        if req_platform_attr not in platform_attrs:
+            errors.append("Platform attribute %s missing" % req_platform_attr)
+
+    return errors
+
+
+def test_ctd_attributes(nc, requirements):
+    """ Tests for required ctd attributes
+    """
+    errors = []
+
+    ctd_attrs = nc.variables['instrument_ctd'].ncattrs()
+    for req_ctd_attr in requirements['ctd_attributes']:
+        if req_ctd_attr not in ctd_attrs:
+            errors.append("CTD attribute %s missing" % req_ctd_attr)
+
+    return errors
+
+
+test_functions = [
+    test_global_attributes,
+    test_dimensions,
+    test_required_variables,
+    test_variable_attributes,
+    test_qc_variables,
+    test_platform_attributes,
+    test_ctd_attributes
+]
+
+
+STANDARDS = {}
+STANDARDS_LOCK = threading.Lock()
+
+
+def load_requirements(standard_path=DEFAULT_STANDARD_PATH):
+    """ Returns the requirements of a standard file with the SHA-1 hash of
+    its contents
+
+    Requirements are shared by every caller in the process and are only
+    parsed again when the standard file is modified.  Do not modify them.
+    """
+
+    mtime = os.path.getmtime(standard_path)
+
+    with STANDARDS_LOCK:
+        standard = STANDARDS.get(standard_path)
+        if standard is not None and standard[0] == mtime:
+            return standard[1:]
+
+        with open(standard_path, 'r') as f:
+            contents = f.read()
+        standard = (
+            mtime, json.loads(contents), hashlib.sha1(contents).hexdigest()
+        )
+        STANDARDS[standard_path] = standard
+
+    return standard[1:]
+
+
+def check_dataset(nc, requirements):
+    """ Runs every test against an open Dataset.  Returns an ordered
+    dictionary of error message lists keyed by test name.  A test that
+    cannot run reports the exception as its error.
+    """
+
+    results = OrderedDict()
+    for test_fun in test_functions:
+        try:
+            results[test_fun.__name__] = test_fun(nc, requirements)
+        except Exception, e:
+            results[test_fun.__name__] = [
+                "%s failed: %s" % (test_fun.__name__, e)
+            ]
+    return results
+
+
+def list_errors(results):
+    """ Returns every error message of check_dataset results
+    """
+
+    return [error for errors in results.values() for error in errors]
+
+
+def count_errors(result):
+    return len(list_errors(result['tests']))
+
+
+def check_file(file_path, requirements):
+    """ Validates one NetCDF file.  Returns a dictionary with the path,
+    the errors of each test and the total error count.
+    """
+
+    result = {'path': file_path, 'tests': OrderedDict()}
+    try:
+        nc = Dataset(file_path, 'r', format='NETCDF4_CLASSIC')
+    except Exception, e:
+        result['tests']['open'] = ["Cannot open file: %s" % (e)]
+    else:
+        try:
+            result['tests'] = check_dataset(nc, requirements)
+        finally:
+            nc.close()
+
+    result['errors'] = count_errors(result)
+    return result
+
+
+def find_netcdf_files(paths):
+    """ Returns the given file paths and every .nc file under the given
+    directories
+    """
+
+    file_paths = []
+    for file_path in paths:
+        if not os.path.isdir(file_path):
+            file_paths.append(file_path)
+            continue
+
+        for root, dirs, files in os.walk(file_path):
+            dirs.sort()
+            file_paths.extend(
+                os.path.join(root, name)
+                for name in sorted(files) if name.endswith('.nc')
+            )
+
+    return file_paths
+
+
+def load_results_cache(cache_path):
+    if cache_path is None or not os.path.exists(cache_path):
+        return {}
+
+    with open(cache_path, 'r') as f:
+        return json.load(f, object_pairs_hook=OrderedDict)
+
+
+def save_results_cache(cache_path, cache):
+    # Replace the cache at once so that an interrupted run leaves the
+    # previous cache intact
+    temp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+    with open(temp_path, 'w') as f:
+        json.dump(cache, f)
+    os.rename(temp_path, cache_path)
+
+
+def find_file_version(file_path, standard_hash):
+    """ Returns the modification time and size of a file with the hash
+    of the standard it is checked against, or None if the file cannot be
+    read.  A cached result is valid while these are unchanged.
+    """
+
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+
+    return [stat.st_mtime, stat.st_size, standard_hash]
+
+
+# Requirements for pool workers.  Set before the pool forks.
+WORKER_REQUIREMENTS = {}
+
+
+def check_file_job(file_path):
+    return check_file(file_path, WORKER_REQUIREMENTS['requirements'])
+
+
+def check_files(file_paths, requirements, standard_hash,
+                jobs=1, cache_path=None):
+    """ Validates many files, jobs files at a time.  Returns a list of
+    results in the order of file_paths.  Each result has a cached flag.
+
+    If cache_path is set, results are read from and saved to that JSON
+    file, keyed by absolute path.  Files that have not changed since
+    their cached result are not opened again.
+    """
+
+    cache = load_results_cache(cache_path)
+
+    results = [None] * len(file_paths)
+    versions = [find_file_version(file_path, standard_hash)
+                for file_path in file_paths]
+    unchecked = []
+    for i, file_path in enumerate(file_paths):
+        cached = cache.get(os.path.abspath(file_path))
+        if versions[i] is not None and cached is not None and \
+                cached['version'] == versions[i]:
+            results[i] = dict(cached['result'], path=file_path, cached=True)
+        else:
+            unchecked.append(i)
+
+    unchecked_paths = [file_paths[i] for i in unchecked]
+    if jobs > 1 and len(unchecked_paths) > 1:
+        WORKER_REQUIREMENTS['requirements'] = requirements
+        pool = Pool(min(jobs, len(unchecked_paths)))
+        try:
+            checked = pool.map(
+                check_file_job, unchecked_paths,
+                chunksize=max(1, len(unchecked_paths) // (jobs * 4))
+            )
+        finally:
+            pool.close()
+            pool.join()
+            WORKER_REQUIREMENTS.clear()
+    else:
+        checked = [check_file(file_path, requirements)
+                   for file_path in unchecked_paths]
+
+    for i, result in zip(unchecked, checked):
+        if versions[i] is not None:
+            cache[os.path.abspath(file_paths[i])] = {
+                'version': versions[i],
+                'result': dict(
+                    (name, result[name]) for name in ('tests', 'errors')
+                )
+            }
+        result['cached'] = False
+        results[i] = result
+
+    if cache_path is not None and len(checked) > 0:
+        save_results_cache(cache_path, cache)
+
+    return results
@@ -0,0 +1,813 @@
+# GLIDER_NETCDF_WRITER.PROCESSING - Turns a set of glider binary data files
+#   into one NetCDF file per profile.  Used by create_glider_netcdf.py and
+#   gdam_netcdf_subscriber.py.
+#
+# Depends on the glider_binary_data_reader and glider_utils libraries:
+# https://github.com/USF-COT/glider_binary_data_reader
+# https://github.com/USF-COT/glider_utils
+#
+# By: Michael Lindemuth <mlindemu@usf.edu>
+# University of South Florida
+# College of Marine Science
+# Ocean Technology Group
+
+from glider_binary_data_reader import (
+    GliderBDReader,
+    MergedGliderBDReader
+)
+
+from glider_binary_data_reader.methods import parse_glider_filename
+
+from glider_netcdf_writer import (
+    open_glider_netcdf,
+    load_datatype_registry
+)
+
+import os
+import json
+import resource
+import copy
+import glob
+import tempfile
+import threading
+import time
+from array import array
+from multiprocessing import Pool
+
+from datetime import datetime
+from collections import namedtuple
+
+import numpy as np
+from glider_utils.yo import find_yo_extrema
+from glider_utils.yo.filters import default_filter
+from glider_utils.gps import interpolate_gps
+
+
+# Flight and science file extensions for each file naming mode
+MODE_EXTENSIONS = {
+    'rt': {
+        'flight': ('.sbd', '.mbd'),
+        'science': ('.tbd', '.nbd')
+    },
+    'delayed': {
+        'flight': ('.dbd',),
+        'science': ('.ebd',)
+    }
+}
+
+# Values of the depth averaged current that are kept with a profile
+UV_KEYS = (
+    'm_present_time-timestamp',
+    'm_water_vx-m/s',
+    'm_water_vy-m/s',
+    'm_gps_lat-lat',
+    'm_gps_lon-lon'
+)
+
+# Rows decoded into memory at a time when spilling a table to disk
+SPILL_CHUNK_ROWS = 4096
+
+
+def create_reader(flight_path, science_path):
+    if flight_path is not None:
+        flight_reader = GliderBDReader(
+            [flight_path]
+        )
+        if science_path is None:
+            return flight_reader
+    if science_path is not None:
+        science_reader = GliderBDReader(
+            [science_path]
+        )
+        if flight_path is None:
+            return science_reader
+
+    return MergedGliderBDReader(flight_reader, science_reader)
+
+
+def find_table_keys(time_name, depth_name, gps_prefix):
+    """ Returns the reader value names that processing uses: the keys of
+    datatypes.json, the time, depth and GPS values and the depth averaged
+    current values.  Other sensors are not decoded into tables.
+    """
+
+    keys = set(load_datatype_registry().datatypes)
+    keys.update([
+        time_name, depth_name,
+        gps_prefix + 'lat-lat', gps_prefix + 'lon-lon'
+    ])
+    keys.update(UV_KEYS)
+    return keys
+
+
+def decode_table(flight_path, science_path, keys, spill_path=None):
+    """ Decodes the values of keys in the flight and science files once
+    into a table of columns: a dictionary of equal length float64 NumPy
+    arrays keyed by reader value names.  Values missing from a line are
+    NaN.  Keys without any values have no column.
+
+    If spill_path is set, the table is stored in a memory-mapped file at
+    that path instead of in memory.
+    """
+
+    reader = create_reader(flight_path, science_path)
+    if spill_path is not None:
+        return spill_table(reader, keys, spill_path)
+
+    # Each column is built as (row, value) pairs so that sparse science
+    # values do not cost a slot on every row while decoding
+    rows = {}
+    values = {}
+    row_count = 0
+    for line in reader:
+        for name, value in line.iteritems():
+            if name not in keys:
+                continue
+            if name not in rows:
+                rows[name] = array('l')
+                values[name] = array('d')
+            rows[name].append(row_count)
+            values[name].append(value)
+        row_count += 1
+
+    table = {}
+    for name in sorted(rows.keys()):
+        column = np.empty(row_count, 'f8')
+        column.fill(np.nan)
+        column[np.frombuffer(rows.pop(name), 'l')] = (
+            np.frombuffer(values.pop(name), 'f8')
+        )
+        table[name] = column
+
+    return table
+
+
+def spill_table(reader, keys, spill_path):
+    """ Decodes the values of keys SPILL_CHUNK_ROWS lines at a time into
+    a scratch file of rows, then copies them into a memory-mapped .npy
+    file at spill_path with one contiguous row of the file per column.
+    Only one chunk of rows is held in memory at a time.
+    """
+
+    names = sorted(keys)
+    columns = dict((name, i) for i, name in enumerate(names))
+    found = np.zeros(len(names), bool)
+    chunk = np.empty((SPILL_CHUNK_ROWS, len(names)), 'f8')
+
+    rows_path = spill_path + '.rows'
+    row_count = 0
+    try:
+        with open(rows_path, 'wb') as rows_file:
+            row = 0
+            chunk.fill(np.nan)
+            for line in reader:
+                for name, value in line.iteritems():
+                    column = columns.get(name)
+                    if column is not None:
+                        chunk[row, column] = value
+                row += 1
+                if row == SPILL_CHUNK_ROWS:
+                    found |= ~np.all(np.isnan(chunk), axis=0)
+                    chunk.tofile(rows_file)
+                    chunk.fill(np.nan)
+                    row_count += row
+                    row = 0
+            found |= ~np.all(np.isnan(chunk[:row]), axis=0)
+            chunk[:row].tofile(rows_file)
+            row_count += row
+
+        indices = np.flatnonzero(found)
+        storage = np.lib.format.open_memmap(
+            spill_path, mode='w+', dtype='f8',
+            shape=(len(indices), row_count)
+        )
+        if row_count > 0:
+            rows = np.memmap(
+                rows_path, 'f8', 'r', shape=(row_count, len(names))
+            )
+            for start in range(0, row_count, SPILL_CHUNK_ROWS):
+                end = start + SPILL_CHUNK_ROWS
+                storage[:, start:end] = rows[start:end][:, indices].T
+            del rows
+        storage.flush()
+    finally:
+        os.remove(rows_path)
+
+    return dict(
+        (names[index], storage[i]) for i, index in enumerate(indices)
+    )
+
+
+def measure_memory(table):
+    """ Returns the number of rows and values of a decoded table, its size
+    in bytes and the peak memory of this process in bytes
+    """
+
+    table_bytes = sum(column.nbytes for column in table.values())
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1000
+    row_count = max([len(column) for column in table.values()] or [0])
+    return {
+        'rows': row_count,
+        'values': len(table),
+        'table_bytes': table_bytes,
+        'peak_rss': peak_rss
+    }
+
+
+def find_profiles(table, time_name, depth_name):
+    has_depth = ~np.isnan(table[depth_name])
+    profile_dataset = find_yo_extrema(
+        table[time_name][has_depth], table[depth_name][has_depth]
+    )
+    return default_filter(profile_dataset)
+
+
+def get_file_set_gps(table, time_name, gps_prefix):
+    lat_name = gps_prefix + 'lat-lat'
+    lon_name = gps_prefix + 'lon-lon'
+    timestamps = table[time_name]
+
+    gps_values = np.empty((len(timestamps), 3))
+    gps_values.fill(np.nan)
+    gps_values[:, 0] = timestamps
+    if lat_name in table:
+        has_gps = ~np.isnan(table[lat_name])
+        gps_values[has_gps, 1] = table[lat_name][has_gps]
+        gps_values[has_gps, 2] = table[lon_name][has_gps]
+
+    gps_values[:, 1], gps_values[:, 2] = interpolate_gps(
+        gps_values[:, 0], gps_values[:, 1], gps_values[:, 2]
+    )
+
+    # Sort by time so positions can be looked up with searchsorted
+    return gps_values[np.argsort(gps_values[:, 0], kind='mergesort')]
+
+
+def find_gps_indices(interp_gps, timestamps):
+    """ Returns the index of the first interp_gps row for each timestamp
+    """
+
+    indices = np.searchsorted(interp_gps[:, 0], timestamps)
+    if np.any(indices == len(interp_gps)) or np.any(
+        interp_gps[np.minimum(indices, len(interp_gps) - 1), 0] != timestamps
+    ):
+        raise IndexError('Timestamp missing from interpolated GPS')
+
+    return indices
+
+
+def fill_table_gps(table, interp_gps, time_name, gps_prefix):
+    """ Fills the missing positions of a decoded table from the
+    interpolated GPS track in place
+    """
+
+    lat_name = gps_prefix + 'lat-lat'
+    lon_name = gps_prefix + 'lon-lon'
+    for name in (lat_name, lon_name):
+        if name not in table:
+            table[name] = np.empty(len(table[time_name]))
+            table[name].fill(np.nan)
+
+    missing = np.isnan(table[lat_name])
+    indices = find_gps_indices(interp_gps, table[time_name][missing])
+    table[lat_name][missing] = interp_gps[indices, 1]
+    table[lon_name][missing] = interp_gps[indices, 2]
+
+
+def init_netcdf(glider_nc, attrs, segment_id, profile_id):
+    init_header(glider_nc, attrs)
+
+    # Set Segment ID
+    glider_nc.set_segment_id(segment_id)
+
+    # Set Profile ID
+    glider_nc.set_profile_id(profile_id)
+
+
+def init_header(glider_nc, attrs):
+    # Set global attributes
+    glider_nc.set_global_attributes(attrs['global'])
+
+    # Set Trajectory
+    glider_nc.set_trajectory_id(
+        attrs['deployment']['glider'],
+        attrs['deployment']['trajectory_date']
+    )
+
+    # Set Platform
+    glider_nc.set_platform(attrs['deployment']['platform'])
+
+    # Set Instruments
+    glider_nc.set_instruments(attrs['instruments'])
+
+
+def find_segment_id(flight_path, science_path):
+    if flight_path is None:
+        filename = science_path
+    else:
+        filename = flight_path
+
+    details = parse_glider_filename(filename)
+    return details['segment']
+
+
+def fill_uv_variables(dst_glider_nc, uv_values):
+    for key, value in uv_values.items():
+        dst_glider_nc.set_scalar(key, value)
+
+
+def find_profile_slices(table, profiles):
+    """ Splits the rows of a decoded table into profiles
+
+    Returns a list of (profile_id, start, end) row ranges.  A profile
+    starts at the first row after the previous profile and runs until
+    the first row past the last profile time.
+    """
+
+    timestamps = table['timestamp']
+    slices = []
+    start = 0
+    profile_id = 0
+    while start < len(timestamps):
+        profile = profiles[profiles[:, 2] == profile_id]
+        if len(profile) == 0:
+            break  # Rows after the last profile are not written
+
+        profile_end = max(profile[:, 0])
+        after = np.flatnonzero(timestamps[start:] > profile_end)
+        if len(after) > 0:
+            end = start + after[0]
+        else:
+            end = len(timestamps)
+
+        if end > start:
+            slices.append((profile_id, start, end))
+        start = end
+        profile_id += 1
+
+    return slices
+
+
+def find_uv_values(table, start, end):
+    """ Returns the depth averaged current values measured in a row range
+    of a decoded table, or None if there are none.
+    """
+
+    if 'm_water_vx-m/s' not in table:
+        return None
+
+    measured = np.flatnonzero(~np.isnan(table['m_water_vx-m/s'][start:end]))
+    if len(measured) == 0:
+        return None
+
+    def last_value(name, row=None):
+        if name not in table:
+            return None
+        if row is None:
+            valid = np.flatnonzero(~np.isnan(table[name][start:end]))
+            if len(valid) == 0:
+                return None
+            row = start + valid[-1]
+        return table[name][row]
+
+    row = start + measured[-1]
+    return {
+        'time_uv': last_value('m_present_time-timestamp', row),
+        'm_water_vx-m/s': last_value('m_water_vx-m/s', row),
+        'm_water_vy-m/s': last_value('m_water_vy-m/s'),
+        'lon_uv': last_value('m_gps_lon-lon', row),
+        'lat_uv': last_value('m_gps_lat-lat', row)
+    }
+
+
+def plan_uv_fills(table, slices):
+    """ Finds the depth averaged current values to fill in for each
+    profile slice that has none of its own.  Profiles use the latest
+    earlier values.  Profiles before the first measurement use the first
+    measurement.  Returns a list with a dictionary or None per slice.
+    """
+
+    measured = [find_uv_values(table, start, end)
+                for profile_id, start, end in slices]
+
+    fills = [None] * len(slices)
+    uv_values = None
+    pending = []
+    for i, values in enumerate(measured):
+        if values is not None:
+            uv_values = values
+            for j in pending:
+                fills[j] = values
+            del pending[:]
+        elif uv_values is not None:
+            fills[i] = uv_values
+        else:
+            pending.append(i)
+
+    return fills
+
+
+GliderConfig = namedtuple('GliderConfig', ['mtimes', 'attrs'])
+
+GLIDER_CONFIGS = {}
+GLIDER_CONFIGS_LOCK = threading.Lock()
+
+
+def find_config_paths(glider_config_path, glider_name):
+    return (
+        os.path.join(glider_config_path, "global_attributes.json"),
+        os.path.join(glider_config_path, glider_name, "deployment.json"),
+        os.path.join(glider_config_path, glider_name, "instruments.json")
+    )
+
+
+def find_storage_policy_path(glider_config_path, glider_name):
+    return os.path.join(
+        glider_config_path, glider_name, "storage_policy.json"
+    )
+
+
+def read_attrs(glider_config_path, glider_name):
+    """ Returns the attributes of a glider: the institution global
+    attributes merged with the deployment global attributes, the
+    deployment, the instruments and the optional storage policy written
+    by tune_glider_storage.py.
+
+    Attributes are shared by every caller in the process and are only
+    parsed again when one of the configuration files is modified.  Do not
+    modify them.
+    """
+
+    config_paths = find_config_paths(glider_config_path, glider_name)
+    storage_policy_path = find_storage_policy_path(
+        glider_config_path, glider_name
+    )
+    mtimes = tuple(
+        os.path.getmtime(config_path) for config_path in config_paths
+    )
+    # The storage policy is optional
+    if os.path.exists(storage_policy_path):
+        mtimes += (os.path.getmtime(storage_policy_path),)
+
+    key = (glider_config_path, glider_name)
+    with GLIDER_CONFIGS_LOCK:
+        config = GLIDER_CONFIGS.get(key)
+        if config is not None and config.mtimes == mtimes:
+            return config.attrs
+
+        # Load in configurations
+        attrs = {}
+        global_attrs_path, deployment_attrs_path, instruments_attrs_path = (
+            config_paths
+        )
+
+        # Load institute global attributes
+        with open(global_attrs_path, 'r') as f:
+            attrs['global'] = json.load(f)
+
+        # Load deployment attributes (including global attributes)
+        with open(deployment_attrs_path, 'r') as f:
+            attrs['deployment'] = json.load(f)
+
+        # Load instruments
+        with open(instruments_attrs_path, 'r') as f:
+            attrs['instruments'] = json.load(f)
+
+        # Load storage settings by variable name
+        attrs['storage_policy'] = {}
+        if len(mtimes) > len(config_paths):
+            with open(storage_policy_path, 'r') as f:
+                attrs['storage_policy'] = json.load(f)
+
+        # Fill in global attributes
+        attrs['global'].update(attrs['deployment']['global_attributes'])
+
+        GLIDER_CONFIGS[key] = GliderConfig(mtimes, attrs)
+
+    return attrs
+
+
+# The attributes and datatype registry that a template was written for,
+# its storage settings and the contents of the template file
+HeaderTemplate = namedtuple(
+    'HeaderTemplate', ['attrs', 'registry', 'storage', 'contents']
+)
+
+HEADER_TEMPLATES = {}
+HEADER_TEMPLATES_LOCK = threading.Lock()
+
+
+def find_template_keys(table):
+    """ Returns the keys of the time datatypes in a table, timestamp
+    first.  Every profile of the table has variables for these keys.
+    """
+
+    time_keys = load_datatype_registry().time_keys
+    return tuple(sorted(
+        (name for name in table if name in time_keys),
+        key=lambda name: (name != 'timestamp', name)
+    ))
+
+
+def get_header_template(attrs, keys, storage=None):
+    """ Returns the contents of a NetCDF file with no records that holds
+    the header of a glider: its global attributes, trajectory, platform,
+    instruments, segment and profile ID variables and the variables of
+    keys.  Profile files copy it with the TEMPLATE writer argument.
+
+    Templates are kept in memory and shared by every caller in the
+    process.  A template is written again when read_attrs or
+    load_datatype_registry reload a modified configuration.
+    """
+
+    registry = load_datatype_registry()
+    key = (attrs['deployment']['glider'], keys)
+    with HEADER_TEMPLATES_LOCK:
+        template = HEADER_TEMPLATES.get(key)
+        if template is not None and template.attrs is attrs and \
+                template.registry is registry and \
+                template.storage == storage:
+            return template.contents
+
+        fd, template_path = tempfile.mkstemp(suffix='.nc')
+        os.close(fd)
+        try:
+            with open_glider_netcdf(template_path, 'w', STORAGE=storage,
+                                    STORAGE_POLICY=attrs['storage_policy']) \
+                    as glider_nc:
+                init_header(glider_nc, attrs)
+                for name in ('segment_id', 'profile_id') + keys:
+                    glider_nc.check_datatype_exists(name)
+            with open(template_path, 'rb') as f:
+                contents = f.read()
+        finally:
+            os.remove(template_path)
+
+        HEADER_TEMPLATES[key] = HeaderTemplate(
+            attrs, registry, storage, contents
+        )
+
+    return contents
+
+
+def find_storage(args):
+    if args.quantize:
+        return {'least_significant_digit': 'auto'}
+    return None
+
+
+def write_profile(table, args, attrs, profile_id, start, end, uv_values):
+    """ Writes one profile of the table to a new NetCDF file.  Returns
+    the file path with the seconds spent writing the file, the seconds
+    spent calculating derived variables and the error message of
+    calculate_derived, or None.
+    """
+
+    write_start = time.time()
+    begin_time = datetime.fromtimestamp(table['timestamp'][start])
+    filename = "%s_%s_%s.nc" % (
+        args.glider_name,
+        begin_time.isoformat(),
+        args.mode
+    )
+    file_path = os.path.join(
+        args.output_path,
+        filename
+    )
+
+    storage = find_storage(args)
+    template = get_header_template(
+        attrs, find_template_keys(table), storage
+    )
+
+    with open_glider_netcdf(file_path, 'w',
+                            DISKLESS=args.diskless,
+                            VALIDATE=args.validate,
+                            STORAGE=storage,
+                            STORAGE_POLICY=attrs['storage_policy'],
+                            TEMPLATE=template) as glider_nc:
+        # NOTE: Store 1 based profile id
+        glider_nc.set_segment_id(args.segment_id)
+        glider_nc.set_profile_id(profile_id + 1)
+
+        glider_nc.insert_batch(dict(
+            (name, column[start:end]) for name, column in table.items()
+        ))
+
+        # Handle UV Variables
+        if uv_values is not None:
+            fill_uv_variables(glider_nc, uv_values)
+
+        glider_nc.update_profile_vars()
+        derived_start = time.time()
+        derived_error = None
+        try:
+            glider_nc.calculate_derived()
+        except Exception, ex:
+            derived_error = "(%s)- %s" % (file_path, ex)
+        derived_time = time.time() - derived_start
+
+    write_time = time.time() - write_start - derived_time
+    return file_path, write_time, derived_time, derived_error
+
+
+# Decoded table, arguments and attributes for pool workers.  Set before
+# the pool forks so that workers share the table memory instead of
+# receiving pickled copies of the rows.
+WORKER_DATASET = {}
+
+
+def write_profile_job(job):
+    return write_profile(
+        WORKER_DATASET['table'],
+        WORKER_DATASET['args'],
+        WORKER_DATASET['attrs'],
+        *job
+    )
+
+
+def process_dataset(args, attrs):
+    """ Creates the NetCDF files of one flight/science file pair.  Returns
+    the seconds spent in each processing phase, the number of profiles
+    written, the errors of derived variables and the measure_memory
+    results.  Write and derived times are summed over all profiles.
+    """
+
+    # Decode the flight and science files once
+    phase_start = time.time()
+    table = decode_table(
+        args.flight, args.science,
+        find_table_keys(args.time, args.depth, args.gps_prefix),
+        args.spill_path
+    )
+    decode_time = time.time() - phase_start
+
+    # Find profile breaks
+    phase_start = time.time()
+    profiles = find_profiles(table, args.time, args.depth)
+
+    # Interpolate GPS and fill in missing positions
+    interp_gps = get_file_set_gps(table, args.time, args.gps_prefix)
+    fill_table_gps(table, interp_gps, args.time, args.gps_prefix)
+
+    # Create NetCDF Files for Each Profile
+    slices = find_profile_slices(table, profiles)
+    uv_fills = plan_uv_fills(table, slices)
+    jobs = [
+        (profile_id, start, end, uv_values)
+        for (profile_id, start, end), uv_values in zip(slices, uv_fills)
+    ]
+    profile_time = time.time() - phase_start
+
+    if args.jobs > 1 and len(jobs) > 1:
+        # Write the header template before the pool forks so that every
+        # worker copies the same one
+        get_header_template(attrs, find_template_keys(table),
+                            find_storage(args))
+        WORKER_DATASET.update(table=table, args=args, attrs=attrs)
+        pool = Pool(min(args.jobs, len(jobs)))
+        try:
+            written = pool.map(write_profile_job, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+            WORKER_DATASET.clear()
+    else:
+        written = [write_profile(table, args, attrs, *job) for job in jobs]
+
+    result = measure_memory(table)
+    result.update({
+        'decode': decode_time,
+        'profile_detection': profile_time,
+        'write': sum(write_time for _, write_time, _, _ in written),
+        'derived': sum(derived_time for _, _, derived_time, _ in written),
+        'profiles': len(written),
+        'derived_errors': [
+            error for _, _, _, error in written if error is not None
+        ]
+    })
+    return result
+
+
+def get_file_prefix(file_path):
+    return os.path.split(file_path)[1].rsplit('.')[0]
+
+
+def find_segments(batch_path, mode):
+    """ Pairs the flight and science files of a mode in a directory or
+    glob by file name prefix.  Returns a list of (flight_path,
+    science_path) tuples sorted by prefix.  Either path may be None.
+    """
+
+    if os.path.isdir(batch_path):
+        paths = glob.glob(os.path.join(batch_path, '*'))
+    else:
+        paths = glob.glob(batch_path)
+
+    extensions = MODE_EXTENSIONS[mode]
+    segments = {}
+    for file_path in sorted(paths):
+        extension = os.path.splitext(file_path)[1].lower()
+        if extension in extensions['flight']:
+            slot = 0
+        elif extension in extensions['science']:
+            slot = 1
+        else:
+            continue
+        prefix = get_file_prefix(file_path)
+        segments.setdefault(prefix, [None, None])[slot] = file_path
+
+    return [tuple(segments[key]) for key in sorted(segments)]
+
+
+def prefetch_files(file_paths):
+    """ Reads files so that they are in the page cache when decoded
+    """
+
+    for file_path in file_paths:
+        with open(file_path, 'rb') as f:
+            while f.read(1024 * 1024):
+                pass
+
+
+def process_segment(job):
+    args, attrs, prefetch_paths = job
+
+    prefetch = threading.Thread(target=prefetch_files, args=(prefetch_paths,))
+    prefetch.daemon = True
+    prefetch.start()
+
+    try:
+        report_dataset(process_dataset(args, attrs))
+        return True
+    except Exception, ex:
+        print "(%s)- %s" % (args.flight or args.science, ex)
+        return False
+    finally:
+        prefetch.join()
+
+
+def report_dataset(result):
+    """ Prints the errors of derived variables and the memory used by
+    process_dataset
+    """
+
+    for error in result['derived_errors']:
+        print error
+    print "Decoded %d rows x %d values (%.1f MB), peak memory %.1f MB" % (
+        result['rows'], result['values'], result['table_bytes'] / 1e6,
+        result['peak_rss'] / 1e6
+    )
+
+
+def process_batch(args, attrs):
+    """ Processes every segment found by find_segments, args.jobs
+    segments at a time.  Each segment prefetches the files of the segment
+    that starts after it.  Returns the number of failed segments.
+    """
+
+    segments = find_segments(args.batch, args.mode)
+    workers = max(args.jobs, 1)
+
+    jobs = []
+    for i, (flight_path, science_path) in enumerate(segments):
+        segment_args = copy.copy(args)
+        segment_args.flight = flight_path
+        segment_args.science = science_path
+        segment_args.segment_id = find_segment_id(flight_path, science_path)
+        segment_args.jobs = 1
+
+        prefetch_paths = []
+        if i + workers < len(segments):
+            prefetch_paths = [
+                file_path for file_path in segments[i + workers]
+                if file_path is not None
+            ]
+        jobs.append((segment_args, attrs, prefetch_paths))
+
+    start_time = time.time()
+    if workers > 1 and len(jobs) > 1:
+        pool = Pool(min(workers, len(jobs)))
+        try:
+            results = pool.map(process_segment, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [process_segment(job) for job in jobs]
+    elapsed = max(time.time() - start_time, 1e-6)
+
+    input_bytes = sum(
+        os.path.getsize(file_path)
+        for segment in segments for file_path in segment
+        if file_path is not None
+    )
+    failures = results.count(False)
+    print ("Processed %d segments (%d failed) in %.1f s: "
+           "%.2f segments/s, %.2f MB/s" % (
+               len(segments), failures, elapsed,
+               len(segments) / elapsed, input_bytes / 1e6 / elapsed
+           ))
+
+    return failures
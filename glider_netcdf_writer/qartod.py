@@ -0,0 +1,215 @@
+# qartod.py - Vectorized QARTOD style quality control tests for glider
+#   time series.
+#
+# Each test takes a column of values with no missing values, the matching
+# times in seconds and its configuration from the "qartod" section of a
+# datatype in datatypes.json.  It returns an equal length int8 array of
+# flags:
+#   0 - Not evaluated (GLIDER_QC no_qc_performed)
+#   1 - Pass (GLIDER_QC good_data)
+#   3 - Suspect (GLIDER_QC bad_data_that_are_potentially_correctable)
+#   4 - Fail (GLIDER_QC bad_data)
+#
+# Every test runs in time linear in the number of values.
+#
+# Example datatypes.json configuration:
+#   "qartod": {
+#       "gross_range": {"fail_span": [-5, 40], "suspect_span": [0, 35]},
+#       "spike": {"suspect_threshold": 1.0, "fail_threshold": 3.0},
+#       "rate_of_change": {"threshold": 0.5},
+#       "flat_line": {"tolerance": 0.001, "suspect_count": 5,
+#                     "fail_count": 10},
+#       "climatology": {"periods": [
+#           {"months": [6, 7, 8], "suspect_span": [20, 32]}
+#       ]}
+#   }
+
+from collections import OrderedDict
+
+import numpy as np
+
+
+NOT_EVALUATED = 0
+PASS = 1
+SUSPECT = 3
+FAIL = 4
+
+
+def new_flags(values, flag=PASS):
+    flags = np.empty(len(values), 'i1')
+    flags.fill(flag)
+    return flags
+
+
+def gross_range(values, times, fail_span, suspect_span=None):
+    """ Fails values outside fail_span and marks values outside
+    suspect_span as suspect
+    """
+
+    flags = new_flags(values)
+    if suspect_span is not None:
+        flags[(values < suspect_span[0]) | (values > suspect_span[1])] = (
+            SUSPECT
+        )
+    flags[(values < fail_span[0]) | (values > fail_span[1])] = FAIL
+    return flags
+
+
+def spike(values, times, suspect_threshold, fail_threshold=None):
+    """ Tests how far each value is from the mean of its neighbors.  The
+    first and last values are not evaluated.
+    """
+
+    flags = new_flags(values, NOT_EVALUATED)
+    if len(values) < 3:
+        return flags
+
+    spikes = np.abs(values[1:-1] - (values[:-2] + values[2:]) / 2.0)
+    inner = flags[1:-1]
+    inner.fill(PASS)
+    inner[spikes > suspect_threshold] = SUSPECT
+    if fail_threshold is not None:
+        inner[spikes > fail_threshold] = FAIL
+    return flags
+
+
+def rate_of_change(values, times, threshold):
+    """ Marks values that changed faster than threshold units per second
+    since the previous value as suspect.  The first value is not
+    evaluated.
+    """
+
+    flags = new_flags(values, NOT_EVALUATED)
+    if len(values) < 2:
+        return flags
+
+    elapsed = np.diff(times)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rates = np.abs(np.diff(values) / elapsed)
+    flags[1:] = PASS
+    flags[1:][rates > threshold] = SUSPECT
+    flags[1:][elapsed <= 0] = NOT_EVALUATED
+    return flags
+
+
+def flat_line(values, times, tolerance, suspect_count, fail_count=None):
+    """ Counts how many previous values each value repeats within
+    tolerance.  Marks runs of suspect_count repeats as suspect and
+    fail_count repeats as failed.
+    """
+
+    flags = new_flags(values)
+    if len(values) < 2:
+        return flags
+
+    repeats = np.zeros(len(values), bool)
+    repeats[1:] = np.abs(np.diff(values)) <= tolerance
+
+    # Index of the first value of the run that each value belongs to
+    indices = np.arange(len(values))
+    run_starts = np.maximum.accumulate(np.where(repeats, 0, indices))
+    counts = indices - run_starts
+
+    flags[counts >= suspect_count] = SUSPECT
+    if fail_count is not None:
+        flags[counts >= fail_count] = FAIL
+    return flags
+
+
+def climatology(values, times, periods):
+    """ Marks values outside the suspect_span of the period containing
+    their month (1-12, UTC) as suspect.  Values outside an optional
+    fail_span fail.  Values in months without a period are not evaluated.
+    """
+
+    flags = new_flags(values, NOT_EVALUATED)
+    months = (
+        np.asarray(times, 'i8').astype('datetime64[s]')
+        .astype('datetime64[M]').astype('i8') % 12 + 1
+    )
+
+    for period in periods:
+        in_period = np.in1d(months, period['months'])
+        period_flags = gross_range(
+            values[in_period], times[in_period],
+            period.get('fail_span', [-np.inf, np.inf]),
+            period['suspect_span']
+        )
+        flags[in_period] = period_flags
+    return flags
+
+
+# Tests that datatypes.json may configure, by name
+QARTOD_TESTS = OrderedDict([
+    ('gross_range', gross_range),
+    ('spike', spike),
+    ('rate_of_change', rate_of_change),
+    ('flat_line', flat_line),
+    ('climatology', climatology)
+])
+
+
+def compile_qartod(datatypes):
+    """ Returns the configured tests of each datatype with a "qartod"
+    section as an ordered dictionary of keyword arguments by test name.
+    Raises ValueError for unknown tests.
+    """
+
+    tests = {}
+    for key, desc in datatypes.items():
+        if 'qartod' not in desc:
+            continue
+
+        if desc.get('dimension') != 'time' or 'status_flag' not in desc:
+            raise ValueError(
+                'QARTOD tests of %s need the time dimension and a '
+                'status_flag' % key
+            )
+
+        configured = OrderedDict()
+        for name in QARTOD_TESTS:
+            if name in desc['qartod']:
+                configured[name] = dict(
+                    (str(arg), value)
+                    for arg, value in desc['qartod'][name].items()
+                )
+        unknown = set(desc['qartod']) - set(QARTOD_TESTS)
+        if len(unknown) > 0:
+            raise ValueError(
+                'Unknown QARTOD tests for %s: %s' % (
+                    key, ', '.join(sorted(unknown))
+                )
+            )
+        tests[key] = configured
+
+    return tests
+
+
+def context_size(tests):
+    """ Returns how many earlier values the configured tests compare each
+    value with.  Used to test values appended to a column without testing
+    the whole column again.
+    """
+
+    size = 0
+    if 'spike' in tests or 'rate_of_change' in tests:
+        size = 1
+    if 'flat_line' in tests:
+        flat_line = tests['flat_line']
+        size = max(
+            size, flat_line.get('fail_count') or flat_line['suspect_count']
+        )
+    return size
+
+
+def run_tests(values, times, tests):
+    """ Runs the configured tests on a column.  Returns the worst flag of
+    each value over all tests, or NOT_EVALUATED where no test could
+    evaluate it.
+    """
+
+    flags = new_flags(values, NOT_EVALUATED)
+    for name, kwargs in tests.items():
+        np.maximum(flags, QARTOD_TESTS[name](values, times, **kwargs),
+                   out=flags)
+    return flags
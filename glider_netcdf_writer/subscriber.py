@@ -0,0 +1,482 @@
+# GLIDER_NETCDF_WRITER.SUBSCRIBER - Durable job queue, worker function
+#   and metrics of gdam_netcdf_subscriber.py.
+#
+# By: Michael Lindemuth <mlindemu@usf.edu>
+# University of South Florida
+# College of Marine Science
+# Ocean Technology Group
+
+import argparse
+import json
+import logging
+import os
+import time
+
+from glider_netcdf_writer.checks import ValidationError
+from glider_netcdf_writer.processing import (
+    find_segment_id,
+    process_dataset,
+    read_attrs
+)
+
+logger = logging.getLogger('gdam_netcdf_subscriber')
+metrics_logger = logging.getLogger('gdam_netcdf_subscriber.metrics')
+
+
+MODE_MAPPING = {
+    "rt": [".sbd", ".tbd", ".mbd", ".nbd"],
+    "delayed": [".dbd", ".ebd"]
+}
+
+
+def find_output_path(attrs, args):
+    deployment_vars = attrs['deployment']
+
+    if 'directory' in deployment_vars:
+        return os.path.join(
+            args.output_path,
+            deployment_vars['directory']
+        )
+    else:
+        return args.output_path
+
+
+def find_data_paths(message):
+    return (
+        os.path.join(message['path'], message['flight_file']),
+        os.path.join(message['path'], message['science_path'])
+    )
+
+
+def process_files(message, args):
+    """ Processes the files of a message in a worker.  Returns the
+    process_dataset timings with the time processing started, since jobs
+    can wait in the pool.
+    """
+
+    started = time.time()
+    mode = 'rt'
+
+    filename, extension = os.path.splitext(message['flight_file'])
+    if extension in MODE_MAPPING['delayed']:
+        mode = 'delayed'
+    else:
+        mode = 'rt'
+
+    flight_path, science_path = find_data_paths(message)
+
+    # Configuration is cached by each worker until it is modified
+    attrs = read_attrs(args.glider_config_path, message['glider'])
+
+    # Find the output path for a given deployment
+    deployment_output_path = find_output_path(attrs, args)
+
+    # Create the output directory if necessary
+    if not os.path.exists(deployment_output_path):
+        os.makedirs(deployment_output_path)
+
+    dataset_args = argparse.Namespace(
+        glider_name=message['glider'],
+        output_path=deployment_output_path,
+        mode=mode,
+        segment_id=find_segment_id(flight_path, science_path),
+        time=args.time,
+        depth=args.depth,
+        gps_prefix=args.gps_prefix,
+        flight=flight_path,
+        science=science_path,
+        diskless=args.diskless,
+        validate=args.validate,
+        quantize=args.quantize,
+        spill_path=None,
+        jobs=1
+    )
+    timings = process_dataset(dataset_args, attrs)
+    timings['started'] = started
+    return timings
+
+
+def get_modified_time(file_paths):
+    """ Returns the latest modification time of a set of files, or
+    None if any of them cannot be read
+    """
+
+    try:
+        return max(os.path.getmtime(file_path) for file_path in file_paths)
+    except OSError:
+        return None
+
+
+# Finished jobs are kept this long to recognize repeated messages
+JOB_RETENTION = 7 * 24 * 60 * 60
+
+
+# Seconds between updates of the metrics file while no job finishes
+METRICS_INTERVAL = 10
+
+# Job timing stages in the order they happen
+JOB_STAGES = (
+    'wait', 'decode', 'profile_detection', 'write', 'derived',
+    'processing', 'latency'
+)
+
+# Decoded table size and peak worker memory reported by process_dataset
+JOB_MEMORY = ('rows', 'values', 'table_bytes', 'peak_rss')
+
+
+class SubscriberMetrics(object):
+    """ Job counts and timings since the subscriber started.
+
+    Each finished job is logged to metrics_logger as a JSON line.  If a
+    metrics file is set the totals, queue depth and backlog of each glider
+    are written to it in Prometheus text format.
+    """
+
+    def __init__(self, metrics_path):
+        self.metrics_path = metrics_path
+        self.results = dict.fromkeys(('done', 'retry', 'failed'), 0)
+        self.stage_sums = dict.fromkeys(JOB_STAGES, 0.0)
+        self.stage_counts = dict.fromkeys(JOB_STAGES, 0)
+        self.profiles = 0
+        self.last_latency = {}
+        self.last_write = 0
+
+    def record_job(self, glider, message, result, received, started,
+                   finished, timings=None):
+        self.results[result] += 1
+
+        stages = {
+            'wait': started - received,
+            'processing': finished - started
+        }
+        if result == 'done':
+            stages['latency'] = finished - received
+            self.last_latency[glider] = stages['latency']
+        if timings is not None:
+            self.profiles += timings['profiles']
+            for stage in JOB_STAGES:
+                if stage in timings:
+                    stages[stage] = timings[stage]
+
+        for stage, seconds in stages.items():
+            self.stage_sums[stage] += seconds
+            self.stage_counts[stage] += 1
+
+        record = {
+            'event': 'job',
+            'glider': glider,
+            'flight_file': message['flight_file'],
+            'result': result,
+            'received': received,
+            'started': started,
+            'finished': finished,
+            'profiles': timings['profiles'] if timings else 0
+        }
+        record.update(
+            ('%s_seconds' % (stage), round(seconds, 3))
+            for stage, seconds in stages.items()
+        )
+        if timings is not None:
+            record.update(
+                (name, timings[name]) for name in JOB_MEMORY
+                if name in timings
+            )
+        metrics_logger.info(json.dumps(record, sort_keys=True))
+
+    def write(self, queue, force=False):
+        """ Rewrites the metrics file if forced or if METRICS_INTERVAL
+        has passed since the last write.
+        """
+
+        now = time.time()
+        if self.metrics_path is None or \
+                (not force and now - self.last_write < METRICS_INTERVAL):
+            return
+        self.last_write = now
+
+        lines = [
+            '# HELP gdam_subscriber_queue_depth Jobs waiting to start.',
+            '# TYPE gdam_subscriber_queue_depth gauge',
+            'gdam_subscriber_queue_depth %d' % (queue.size),
+            '# HELP gdam_subscriber_running_jobs Jobs being processed.',
+            '# TYPE gdam_subscriber_running_jobs gauge',
+            'gdam_subscriber_running_jobs %d' % (len(queue.running)),
+            '# HELP gdam_subscriber_glider_backlog Jobs waiting to start '
+            'per glider.',
+            '# TYPE gdam_subscriber_glider_backlog gauge'
+        ]
+        for glider, count in queue.backlog():
+            lines.append(
+                'gdam_subscriber_glider_backlog{glider="%s"} %d' % (
+                    glider, count
+                )
+            )
+
+        lines += [
+            '# HELP gdam_subscriber_jobs_total Finished job attempts '
+            'by result.',
+            '# TYPE gdam_subscriber_jobs_total counter'
+        ]
+        for result in sorted(self.results):
+            lines.append(
+                'gdam_subscriber_jobs_total{result="%s"} %d' % (
+                    result, self.results[result]
+                )
+            )
+
+        lines += [
+            '# HELP gdam_subscriber_profiles_total Profile files written.',
+            '# TYPE gdam_subscriber_profiles_total counter',
+            'gdam_subscriber_profiles_total %d' % (self.profiles),
+            '# HELP gdam_subscriber_job_seconds Seconds spent in each '
+            'stage of a job.',
+            '# TYPE gdam_subscriber_job_seconds summary'
+        ]
+        for stage in JOB_STAGES:
+            lines.append(
+                'gdam_subscriber_job_seconds_sum{stage="%s"} %.6f' % (
+                    stage, self.stage_sums[stage]
+                )
+            )
+            lines.append(
+                'gdam_subscriber_job_seconds_count{stage="%s"} %d' % (
+                    stage, self.stage_counts[stage]
+                )
+            )
+
+        lines += [
+            '# HELP gdam_subscriber_last_latency_seconds Seconds from '
+            'receiving to finishing the last job of a glider.',
+            '# TYPE gdam_subscriber_last_latency_seconds gauge'
+        ]
+        for glider in sorted(self.last_latency):
+            lines.append(
+                'gdam_subscriber_last_latency_seconds{glider="%s"} %.6f' % (
+                    glider, self.last_latency[glider]
+                )
+            )
+
+        # Replace the file at once so that readers never see part of it
+        temp_path = '%s.tmp' % (self.metrics_path)
+        with open(temp_path, 'w') as metrics_file:
+            metrics_file.write('\n'.join(lines) + '\n')
+        os.rename(temp_path, self.metrics_path)
+
+
+class GliderJobQueue(object):
+    """ Queue of messages waiting to be processed, stored in a SQLite
+    database so that no message is lost when the subscriber stops.  Every
+    received message is stored.  At most max_size jobs are handed to the
+    worker pool at once.
+
+    Each job is pending, running, done or failed.  Jobs left running by a
+    crash are pending again on start up.  Failed jobs are retried with a
+    doubling delay until max_attempts is reached, except for files that
+    fail validation.  A message for a
+    flight/science pair that is already pending is merged into that job.
+    One for a pair that is running or done only creates a new job if its
+    files changed after that job started.  One for a pair that failed
+    always creates a new job.
+
+    Messages for a glider are processed one at a time in the order they
+    were received.  Messages for different gliders are processed at the
+    same time by a pool of worker processes.  db is a sqlite3 connection.
+    """
+
+    def __init__(self, db, pool, max_size, args, metrics):
+        self.db = db
+        self.pool = pool
+        self.metrics = metrics
+        self.max_size = max_size
+        self.args = args
+        self.running = {}
+
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "glider TEXT NOT NULL, "
+            "data_paths TEXT NOT NULL, "
+            "message TEXT NOT NULL, "
+            "state TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "received REAL NOT NULL, "
+            "started REAL, "
+            "finished REAL, "
+            "next_attempt REAL NOT NULL, "
+            "error TEXT)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_data_paths "
+            "ON jobs (glider, data_paths)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)"
+        )
+        with self.db:
+            recovered = self.db.execute(
+                "UPDATE jobs SET state = 'pending' WHERE state = 'running'"
+            ).rowcount
+            self.db.execute(
+                "DELETE FROM jobs WHERE state IN ('done', 'failed') "
+                "AND finished < ?", (time.time() - JOB_RETENTION,)
+            )
+        if recovered > 0:
+            logger.info("Resuming %d interrupted jobs" % (recovered))
+
+        self.size = self.db.execute(
+            "SELECT COUNT(*) FROM jobs WHERE state = 'pending'"
+        ).fetchone()[0]
+
+    def backlog(self):
+        return self.db.execute(
+            "SELECT glider, COUNT(*) FROM jobs WHERE state = 'pending' "
+            "GROUP BY glider ORDER BY glider"
+        ).fetchall()
+
+    def add(self, message):
+        data_paths = json.dumps(find_data_paths(message))
+        now = time.time()
+
+        with self.db:
+            previous = self.db.execute(
+                "SELECT id, state, started FROM jobs "
+                "WHERE glider = ? AND data_paths = ? "
+                "ORDER BY id DESC LIMIT 1", (message['glider'], data_paths)
+            ).fetchone()
+
+            if previous is not None:
+                job_id, state, started = previous
+                if state == 'pending':
+                    self.db.execute(
+                        "UPDATE jobs SET message = ? WHERE id = ?",
+                        (json.dumps(message), job_id)
+                    )
+                    logger.info("Merged repeated message for %s" % (
+                        message['flight_file']
+                    ))
+                    return
+
+                # Failed jobs are tried again when their message is resent
+                modified = get_modified_time(find_data_paths(message))
+                if state != 'failed' and modified is not None and \
+                        started is not None and modified < started:
+                    logger.info("Skipped repeated message for %s" % (
+                        message['flight_file']
+                    ))
+                    return
+
+            self.db.execute(
+                "INSERT INTO jobs (glider, data_paths, message, state, "
+                "received, next_attempt) VALUES (?, ?, ?, 'pending', ?, ?)",
+                (message['glider'], data_paths, json.dumps(message),
+                 now, now)
+            )
+        self.size += 1
+
+    def collect(self):
+        """ Records finished jobs.  Failed jobs are retried later.
+        """
+
+        collected = False
+        for job_id, job in self.running.items():
+            glider, message, result, received, started = job
+            if not result.ready():
+                continue
+
+            del self.running[job_id]
+            collected = True
+            now = time.time()
+            try:
+                timings = result.get()
+            except Exception, e:
+                outcome = self.__record_failure(job_id, message, e, now)
+                self.metrics.record_job(
+                    glider, message, outcome, received, started, now
+                )
+                continue
+
+            started = timings['started']
+            with self.db:
+                self.db.execute(
+                    "UPDATE jobs SET state = 'done', started = ?, "
+                    "finished = ?, error = NULL WHERE id = ?",
+                    (started, now, job_id)
+                )
+            for error in timings['derived_errors']:
+                logger.error(error)
+            logger.info("Processed %s" % (message['flight_file']))
+            self.metrics.record_job(
+                glider, message, 'done', received, started, now, timings
+            )
+
+        self.metrics.write(self, force=collected)
+
+    def __record_failure(self, job_id, message, error, now):
+        attempts = self.db.execute(
+            "SELECT attempts FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()[0]
+
+        # Files that fail validation fail the same way when retried
+        retry = attempts < self.args.max_attempts and \
+            not isinstance(error, ValidationError)
+
+        with self.db:
+            if retry:
+                delay = self.args.retry_delay * 2 ** (attempts - 1)
+                self.db.execute(
+                    "UPDATE jobs SET state = 'pending', next_attempt = ?, "
+                    "error = ? WHERE id = ?",
+                    (now + delay, str(error), job_id)
+                )
+                self.size += 1
+                logger.error("Processing %s failed, retrying in %d s: %s" % (
+                    message['flight_file'], delay, error
+                ))
+                return 'retry'
+            else:
+                self.db.execute(
+                    "UPDATE jobs SET state = 'failed', finished = ?, "
+                    "error = ? WHERE id = ?", (now, str(error), job_id)
+                )
+                logger.error("Processing %s failed %d times: %s" % (
+                    message['flight_file'], attempts, error
+                ))
+                return 'failed'
+
+    def dispatch(self):
+        """ Hands the oldest pending job of every idle glider to the
+        worker pool until max_size jobs are running.  A glider waits for
+        its oldest job to be retried before any later job starts.
+        """
+
+        running_gliders = set(job[0] for job in self.running.values())
+        pending = self.db.execute(
+            "SELECT id, glider, message, received, next_attempt FROM jobs "
+            "WHERE state = 'pending' ORDER BY id"
+        ).fetchall()
+
+        now = time.time()
+        for job_id, glider, message, received, next_attempt in pending:
+            if len(self.running) >= self.max_size:
+                break
+            if glider in running_gliders:
+                continue
+
+            running_gliders.add(glider)
+            if next_attempt > now:
+                continue
+
+            message = json.loads(message)
+            with self.db:
+                self.db.execute(
+                    "UPDATE jobs SET state = 'running', started = ?, "
+                    "attempts = attempts + 1 WHERE id = ?", (now, job_id)
+                )
+            self.size -= 1
+            self.running[job_id] = (
+                glider,
+                message,
+                self.pool.apply_async(process_files, (message, self.args)),
+                received,
+                now
+            )
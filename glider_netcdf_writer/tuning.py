@@ -0,0 +1,199 @@
+# tuning.py - Finds the storage settings of each variable that produce the
+#   smallest files for a set of sample profiles.
+#
+# Every variable is written on its own to one file per sample profile for
+# each combination of compression level, shuffle filter and chunk size.
+# The files also hold the time coordinate and the variables with global
+# bounds, which the writer needs, with their default settings.  The best
+# settings of each variable form a storage policy: a dictionary of storage
+# settings by variable name, which the writer takes as STORAGE_POLICY and
+# processing.read_attrs loads from storage_policy.json in the glider
+# configuration directory.
+#
+# By: Michael Lindemuth <mlindemu@usf.edu>
+# University of South Florida
+# College of Marine Science
+# Ocean Technology Group
+
+import os
+import time
+from collections import namedtuple, OrderedDict
+from itertools import product
+
+import numpy as np
+from netCDF4 import Dataset
+
+from glider_netcdf_writer import (
+    open_glider_netcdf,
+    load_datatype_registry,
+    DEFAULT_GLIDER_BASE
+)
+from glider_netcdf_writer.processing import (
+    decode_table,
+    find_table_keys,
+    find_profiles,
+    find_profile_slices
+)
+
+
+DEFAULT_COMP_LEVELS = (1, 4, 9)
+DEFAULT_SHUFFLES = (True, False)
+DEFAULT_CHUNKSIZES = (256, 1024, 4096)
+
+# Total size in bytes and seconds spent writing and reading the sample
+# files of one variable with one set of storage settings.  storage is
+# None for the writer defaults.
+Measurement = namedtuple(
+    'Measurement', ['storage', 'size', 'write_time', 'read_time']
+)
+
+
+def create_storage_grid(comp_levels=DEFAULT_COMP_LEVELS,
+                        shuffles=DEFAULT_SHUFFLES,
+                        chunksizes=DEFAULT_CHUNKSIZES):
+    return [
+        {'complevel': comp_level, 'shuffle': shuffle, 'chunksizes': chunks}
+        for comp_level, shuffle, chunks in product(
+            comp_levels, shuffles, chunksizes
+        )
+    ]
+
+
+def sample_profiles(segments, count, time_name='timestamp',
+                    depth_name='m_depth-m', gps_prefix='m_gps_'):
+    """ Decodes (flight path, science path) segments and returns count
+    profiles spread evenly over all of their profiles.  Each profile is a
+    dictionary of columns, as passed to insert_batch.
+    """
+
+    keys = find_table_keys(time_name, depth_name, gps_prefix)
+    profiles = []
+    for flight_path, science_path in segments:
+        table = decode_table(flight_path, science_path, keys)
+        slices = find_profile_slices(
+            table, find_profiles(table, time_name, depth_name)
+        )
+        for profile_id, start, end in slices:
+            profiles.append(dict(
+                (name, column[start:end]) for name, column in table.items()
+            ))
+
+    if len(profiles) <= count:
+        return profiles
+    indices = np.linspace(0, len(profiles) - 1, count).round().astype(int)
+    return [profiles[i] for i in indices]
+
+
+def find_tunable_keys(profiles, config_path=DEFAULT_GLIDER_BASE):
+    """ Returns the datatype keys of the time variables that have values
+    in the sample profiles.  Variables calculated from other variables
+    are not in the profiles and keep their configured storage.
+    """
+
+    registry = load_datatype_registry(config_path)
+    keys = set()
+    for columns in profiles:
+        for key, column in columns.items():
+            transform = registry.transforms.get(key)
+            if key in registry.time_keys and \
+                    (transform is None or transform.function is None) and \
+                    not np.all(np.isnan(column)):
+                keys.add(key)
+    return sorted(keys)
+
+
+def measure_storage(profiles, key, storage, work_path,
+                    config_path=DEFAULT_GLIDER_BASE):
+    """ Writes the key column of every profile with the given storage
+    settings and reads it back.  Returns a Measurement.
+    """
+
+    registry = load_datatype_registry(config_path)
+    desc = registry.datatypes[key]
+    names = set(registry.global_bound_keys) | set(['timestamp', key])
+    storage_policy = {}
+    if storage is not None:
+        storage_policy[desc['name']] = storage
+
+    size = 0
+    write_time = 0.0
+    read_time = 0.0
+    for i, columns in enumerate(profiles):
+        file_path = os.path.join(work_path, 'tune_%d.nc' % i)
+        start = time.time()
+        with open_glider_netcdf(file_path, 'w', config_path=config_path,
+                                STORAGE_POLICY=storage_policy) as glider_nc:
+            glider_nc.insert_batch(dict(
+                (name, columns[name]) for name in names if name in columns
+            ))
+        write_time += time.time() - start
+
+        start = time.time()
+        nc = Dataset(file_path, 'r')
+        try:
+            nc.variables[desc['name']][:]
+        finally:
+            nc.close()
+        read_time += time.time() - start
+
+        size += os.path.getsize(file_path)
+        os.remove(file_path)
+
+    return Measurement(storage, size, write_time, read_time)
+
+
+def choose_storage(default, measurements, tolerance=0):
+    """ Returns the default measurement if its size is within tolerance
+    bytes of the smallest size.  Otherwise returns the fastest measurement
+    to write and read of those within tolerance of the smallest size.
+    """
+
+    smallest = min(measurement.size for measurement in measurements)
+    if default.size <= smallest + tolerance:
+        return default
+
+    candidates = [
+        measurement for measurement in measurements
+        if measurement.size <= smallest + tolerance
+    ]
+    return min(
+        candidates,
+        key=lambda measurement: measurement.write_time + measurement.read_time
+    )
+
+
+def tune_storage(profiles, keys, grid, work_path, tolerance=100,
+                 config_path=DEFAULT_GLIDER_BASE, progress=None):
+    """ Measures every storage setting of the grid for each key.  Returns
+    an ordered dictionary of (default, chosen) measurements by variable
+    name.  Settings within tolerance bytes per profile of the smallest
+    files are chosen by speed.  progress is called with each key before
+    it is measured.
+    """
+
+    datatypes = load_datatype_registry(config_path).datatypes
+    results = OrderedDict()
+    for key in keys:
+        if progress is not None:
+            progress(key)
+        default = measure_storage(profiles, key, None, work_path, config_path)
+        measurements = [
+            measure_storage(profiles, key, storage, work_path, config_path)
+            for storage in grid
+        ]
+        results[datatypes[key]['name']] = (
+            default,
+            choose_storage(default, measurements, tolerance * len(profiles))
+        )
+    return results
+
+
+def create_storage_policy(results):
+    """ Returns the storage policy of tune_storage results.  Variables for
+    which the writer defaults were chosen are left out.
+    """
+
+    return OrderedDict(
+        (name, chosen.storage) for name, (default, chosen) in results.items()
+        if chosen.storage is not None
+    )
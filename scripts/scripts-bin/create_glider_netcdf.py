@@ -10,147 +10,16 @@
 
 import argparse
 
-from glider_binary_data_reader import (
-    GliderBDReader,
-    MergedGliderBDReader
-)
-
-from glider_binary_data_reader.methods import parse_glider_filename
-
-from glider_netcdf_writer import (
-    open_glider_netcdf,
-    GLIDER_UV_DATATYPE_KEYS
+from glider_netcdf_writer.processing import (
+    find_segment_id,
+    get_file_prefix,
+    process_batch,
+    process_dataset,
+    read_attrs,
+    report_dataset
 )
 
 import sys
-import os
-import json
-
-from datetime import datetime
-
-import numpy as np
-from glider_utils.yo import find_yo_extrema
-from glider_utils.yo.filters import default_filter
-from glider_utils.gps import interpolate_gps
-
-
-def create_reader(flight_path, science_path):
-    if flight_path is not None:
-        flight_reader = GliderBDReader(
-            [flight_path]
-        )
-        if science_path is None:
-            return flight_reader
-    if science_path is not None:
-        science_reader = GliderBDReader(
-            [science_path]
-        )
-        if flight_path is None:
-            return science_reader
-
-    return MergedGliderBDReader(flight_reader, science_reader)
-
-
-def find_profiles(flight_path, science_path, time_name, depth_name):
-    profile_values = []
-    reader = create_reader(flight_path, science_path)
-    for line in reader:
-        if depth_name in line:
-            profile_values.append([line[time_name], line[depth_name]])
-
-    profile_values = np.array(profile_values)
-    profile_dataset = find_yo_extrema(
-        profile_values[:, 0], profile_values[:, 1]
-    )
-    return default_filter(profile_dataset)
-
-
-def get_file_set_gps(flight_path, science_path, time_name, gps_prefix):
-    gps_values = []
-    reader = create_reader(flight_path, science_path)
-    lat_name = gps_prefix + 'lat-lat'
-    lon_name = gps_prefix + 'lon-lon'
-    for line in reader:
-        if lat_name in line:
-            gps_values.append(
-                [line[time_name], line[lat_name], line[lon_name]]
-            )
-        else:
-            gps_values.append([line[time_name], np.nan, np.nan])
-
-    gps_values = np.array(gps_values)
-    gps_values[:, 1], gps_values[:, 2] = interpolate_gps(
-        gps_values[:, 0], gps_values[:, 1], gps_values[:, 2]
-    )
-
-    return gps_values
-
-
-def fill_gps(line, interp_gps, time_name, gps_prefix):
-    lat_name = gps_prefix + 'lat-lat'
-    lon_name = gps_prefix + 'lon-lon'
-    if lat_name not in line:
-        timestamp = line[time_name]
-        line[lat_name] = interp_gps[interp_gps[:, 0] == timestamp, 1][0]
-        line[lon_name] = interp_gps[interp_gps[:, 0] == timestamp, 2][0]
-
-    return line
-
-
-def init_netcdf(file_path, attrs, segment_id, profile_id):
-    # Check if the output path already exists, remove old file
-    mode = 'w'
-    if os.path.isfile(file_path):
-        os.remove(file_path)
-
-    with open_glider_netcdf(file_path, mode) as glider_nc:
-        # Set global attributes
-        glider_nc.set_global_attributes(attrs['global'])
-
-        # Set Trajectory
-        glider_nc.set_trajectory_id(
-            attrs['deployment']['glider'],
-            attrs['deployment']['trajectory_date']
-        )
-
-        # Set Platform
-        glider_nc.set_platform(attrs['deployment']['platform'])
-
-        # Set Instruments
-        glider_nc.set_instruments(attrs['instruments'])
-
-        # Set Segment ID
-        glider_nc.set_segment_id(segment_id)
-
-        # Set Profile ID
-        glider_nc.set_profile_id(profile_id)
-
-
-def find_segment_id(flight_path, science_path):
-    if flight_path is None:
-        filename = science_path
-    else:
-        filename = flight_path
-
-    details = parse_glider_filename(filename)
-    return details['segment']
-
-
-def fill_uv_variables(dst_glider_nc, uv_values):
-    for key, value in uv_values.items():
-        dst_glider_nc.set_scalar(key, value)
-
-
-def backfill_uv_variables(src_glider_nc, empty_uv_processed_paths):
-    uv_values = {}
-    for key_name in GLIDER_UV_DATATYPE_KEYS:
-        uv_values[key_name] = src_glider_nc.get_scalar(key_name)
-
-    for file_path in empty_uv_processed_paths:
-        with open_glider_netcdf(file_path, 'a') as dst_glider_nc:
-            fill_uv_variables(dst_glider_nc, uv_values)
-
-    return uv_values
 
 
 def create_arg_parser():
@@ -211,129 +80,84 @@ def create_arg_parser():
         default=None
     )
 
+    parser.add_argument(
+        '-b', '--batch',
+        help="Directory or glob of flight and science files to process. "
+             "Files are paired by name and processed as one segment "
+             "per pair.  Use instead of -f and -s.",
+        default=None
+    )
+
     parser.add_argument(
         '-s', '--science',
         help="Science data file to process",
         default=None
     )
 
-    return parser
-
-
-def read_attrs(glider_config_path, glider_name):
-    # Load in configurations
-    attrs = {}
-
-    # Load institute global attributes
-    global_attrs_path = (
-        os.path.join(glider_config_path, "global_attributes.json")
+    parser.add_argument(
+        '--diskless',
+        action='store_true',
+        help="Build each NetCDF file in a temporary file and move it "
+             "into the output directory only once it is complete"
     )
-    with open(global_attrs_path, 'r') as f:
-        attrs['global'] = json.load(f)
 
-    # Load deployment attributes (including global attributes)
-    deployment_attrs_path = (
-        os.path.join(glider_config_path, glider_name,
-                     "deployment.json")
+    parser.add_argument(
+        '--validate',
+        choices=('raise', 'tag'),
+        help="Check each NetCDF file against the glider DAC standard "
+             "before it is closed.  raise: stop and do not write a file "
+             "that fails.  tag: write it with a validation_errors "
+             "global attribute.",
+        default=None
     )
-    with open(deployment_attrs_path, 'r') as f:
-        attrs['deployment'] = json.load(f)
 
-    # Load instruments
-    instruments_attrs_path = (
-        os.path.join(glider_config_path, glider_name,
-                     "instruments.json")
+    parser.add_argument(
+        '--quantize',
+        action='store_true',
+        help="Round variables with numeric resolution or precision attrs "
+             "in datatypes.json to them.  The shipped attrs are blank, so "
+             "this changes nothing until they are set."
     )
-    with open(instruments_attrs_path, 'r') as f:
-        attrs['instruments'] = json.load(f)
-
-    # Fill in global attributes
-    attrs['global'].update(attrs['deployment']['global_attributes'])
-
-    return attrs
 
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        help="Number of processes used to write profiles, or to process "
+             "segments in batch mode.  Default: 1",
+        default=1
+    )
 
-def process_dataset(args, attrs):
-    flight_path = args.flight
-    science_path = args.science
-
-    # Find profile breaks
-    profiles = find_profiles(flight_path, science_path, args.time, args.depth)
-
-    # Interpolate GPS
-    interp_gps = get_file_set_gps(
-        flight_path, science_path, args.time, args.gps_prefix
+    parser.add_argument(
+        '--spill_path',
+        help="Keep the decoded flight and science data in a "
+             "memory-mapped file at this path instead of in memory",
+        default=None
     )
 
-    # Create NetCDF Files for Each Profile
-    profile_id = 0
-    profile_end = 0
-    file_path = None
-    uv_values = None
-    empty_uv_processed_paths = []
-    reader = create_reader(flight_path, science_path)
-    for line in reader:
-        if profile_end < line['timestamp']:
-            # Open new NetCDF
-            begin_time = datetime.fromtimestamp(line['timestamp'])
-            filename = "%s_%s_%s.nc" % (
-                args.glider_name,
-                begin_time.isoformat(),
-                args.mode
-            )
-            file_path = os.path.join(
-                args.output_path,
-                filename
-            )
-
-            profile = profiles[profiles[:, 2] == profile_id]
-
-            # NOTE: Store 1 based profile id
-            init_netcdf(file_path, attrs, args.segment_id, profile_id + 1)
-            profile = profiles[profiles[:, 2] == profile_id]
-            profile_end = max(profile[:, 0])
-
-        with open_glider_netcdf(file_path, 'a') as glider_nc:
-            while line['timestamp'] <= profile_end:
-                line = fill_gps(line, interp_gps, args.time, args.gps_prefix)
-                glider_nc.stream_dict_insert(line)
-                try:
-                    line = reader.next()
-                except StopIteration:
-                    break
-
-            # Handle UV Variables
-            if glider_nc.contains('time_uv'):
-                uv_values = backfill_uv_variables(
-                    glider_nc, empty_uv_processed_paths
-                )
-            elif uv_values is not None:
-                fill_uv_variables(glider_nc, uv_values)
-                del empty_uv_processed_paths[:]
-            else:
-                empty_uv_processed_paths.append(file_path)
-
-            glider_nc.update_profile_vars()
-            try:
-                glider_nc.calculate_salinity()
-                glider_nc.calculate_density()
-            except Exception, ex:
-                print "(%s)- %s" % (file_path, ex)
-
-        profile_id += 1
+    return parser
 
 
 def main():
     parser = create_arg_parser()
     args = parser.parse_args()
 
+    if args.batch is not None:
+        if args.flight is not None or args.science is not None:
+            raise ValueError('Cannot specify flight or science paths '
+                             'in batch mode')
+        if args.spill_path is not None:
+            raise ValueError('Cannot use a spill path in batch mode')
+
+        attrs = read_attrs(args.glider_config_path, args.glider_name)
+        return process_batch(args, attrs)
+
     # Check filenames
     if args.flight is None and args.science is None:
         raise ValueError('Must specify flight, science or both paths')
 
     if args.flight is not None and args.science is not None:
-        flight_prefix = os.path.split(args.flight)[1].rsplit('.')[0]
-        science_prefix = os.path.split(args.science)[1].rsplit('.')[0]
+        flight_prefix = get_file_prefix(args.flight)
+        science_prefix = get_file_prefix(args.science)
         if flight_prefix != science_prefix:
             raise ValueError('Flight and science file names must match')
 
@@ -343,7 +167,7 @@ def main():
 
     attrs = read_attrs(args.glider_config_path, args.glider_name)
 
-    process_dataset(args, attrs)
+    report_dataset(process_dataset(args, attrs))
 
     return 0
 
@@ -5,10 +5,17 @@ import zmq
 
 import os
 import sys
-import subprocess
+import time
+import sqlite3
+from multiprocessing import Pool
 
 import argparse
-import json
+
+from glider_netcdf_writer.subscriber import (
+    GliderJobQueue,
+    SubscriberMetrics,
+    metrics_logger
+)
 
 import logging
 logger = logging.getLogger('gdam_netcdf_subscriber')
@@ -19,8 +26,8 @@ import lockfile
 def parse_args():
     parser = argparse.ArgumentParser(
         description='Listens for GDAM to process new glider binary data '
-                    'files. Runs create_glider_netcdf.py script in a '
-                    'subprocess on new files to produce a NetCDF file.'
+                    'files. Processes new files in a pool of worker '
+                    'processes to produce NetCDF files.'
     )
 
     parser.add_argument(
@@ -57,6 +64,75 @@ def parse_args():
         help="ZMQ url for the GDAM publisher. Default: tcp://localhost:8008"
     )
 
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of worker processes.  Files for different gliders "
+             "are processed at the same time.  Default: 4",
+        default=4
+    )
+    parser.add_argument(
+        "--queue_size",
+        type=int,
+        help="Maximum number of jobs handed to the worker pool at once.  "
+             "Received messages always wait in the job database.  "
+             "Default: 100",
+        default=100
+    )
+
+    parser.add_argument(
+        "--diskless",
+        action="store_true",
+        help="Build each NetCDF file in a temporary file and move it "
+             "into the output directory only once it is complete"
+    )
+
+    parser.add_argument(
+        "--validate",
+        choices=('raise', 'tag'),
+        help="Check each NetCDF file against the glider DAC standard "
+             "before it is closed.  raise: fail the message and do not "
+             "write a file that fails.  tag: write it with a "
+             "validation_errors global attribute.",
+        default=None
+    )
+
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="Round variables with numeric resolution or precision attrs "
+             "in datatypes.json to them.  The shipped attrs are blank, so "
+             "this changes nothing until they are set."
+    )
+
+    parser.add_argument(
+        "--job_db",
+        help="Path of the SQLite database that stores received messages "
+             "until they are processed.  Default: ./gdam_netcdf_sub.db",
+        default="./gdam_netcdf_sub.db"
+    )
+    parser.add_argument(
+        "--max_attempts",
+        type=int,
+        help="Number of times to try processing a message before "
+             "giving up.  Default: 5",
+        default=5
+    )
+    parser.add_argument(
+        "--retry_delay",
+        type=float,
+        help="Seconds to wait before the first retry of a failed message. "
+             "Doubles after every failure.  Default: 60",
+        default=60
+    )
+
+    parser.add_argument(
+        "--metrics_file",
+        help="Path of a Prometheus text format file to update with "
+             "queue and processing time metrics.  Default: none",
+        default=None
+    )
+
     parser.add_argument(
         "--daemonize",
         type=bool,
@@ -77,86 +153,46 @@ def parse_args():
     return parser.parse_args()
 
 
-MODE_MAPPING = {
-    "rt": [".sbd", ".tbd", ".mbd", ".nbd"],
-    "delayed": [".dbd", ".ebd"]
-}
-
-
-def find_output_path(message, args):
-    deployment_vars = {}
-    deployment_attrs_path = (
-        os.path.join(args.config_path, message['glider_name'],
-                     "deployment.json")
-    )
-    with open(deployment_attrs_path, 'r') as f:
-        deployment_vars = json.load(f)
-
-    if 'directory' in deployment_vars:
-        return os.path.join(
-            args.output_path,
-            deployment_vars['directory']
-        )
-    else:
-        return args.output_path
-
-
-def process_files(message, args):
-    mode = 'rt'
-
-    filename, extension = os.path.splitext(message['flight_file'])
-    if extension in MODE_MAPPING['delayed']:
-        mode = 'delayed'
-    else:
-        mode = 'rt'
-
-    flight_path = os.path.join(
-        message['path'],
-        message['flight_file']
-    )
-    science_path = os.path.join(
-        message['path'],
-        message['science_path']
-    )
-
-    # Find the output path for a given deployment
-    deployment_output_path = find_output_path(message, args)
-
-    # Create the output directory if necessary
-    if not os.path.exists(deployment_output_path):
-        os.makedirs(deployment_output_path)
-
-    subprocess.call([
-        "create_glider_netcdf.py",
-        message['glider'],
-        args.config_path,
-        deployment_output_path,
-        "--mode",
-        mode,
-        "-f",
-        flight_path,
-        "-s",
-        science_path
-    ])
-
-
 def run_subscriber(args):
     context = zmq.Context()
     socket = context.socket(zmq.SUB)
     socket.connect(args.zmq_url)
     socket.setsockopt(zmq.SUBSCRIBE, '')
 
-    while True:
-        try:
-            message = socket.recv_json()
-            process_files(message, args)
-        except Exception, e:
-            logger.error("Subscriber exited: %s" % (e))
-            break
+    poller = zmq.Poller()
+    poller.register(socket, zmq.POLLIN)
+
+    pool = Pool(args.workers)
+    metrics = SubscriberMetrics(args.metrics_file)
+    queue = GliderJobQueue(
+        sqlite3.connect(args.job_db), pool, args.queue_size, args, metrics
+    )
+
+    try:
+        while True:
+            try:
+                # Store every waiting message.  The socket drops messages
+                # past its high water mark and loses them on restart.
+                if poller.poll(100):
+                    while poller.poll(0):
+                        queue.add(socket.recv_json())
+
+                queue.collect()
+                queue.dispatch()
+            except Exception, e:
+                # Keep listening.  Received messages are in the job queue.
+                logger.exception("Subscriber error: %s" % (e))
+                time.sleep(1)
+    finally:
+        pool.close()
+        pool.join()
 
 
 def main():
     args = parse_args()
+    args.job_db = os.path.abspath(args.job_db)
+    if args.metrics_file is not None:
+        args.metrics_file = os.path.abspath(args.metrics_file)
 
     # Setup logger
     logger.setLevel(logging.INFO)
@@ -169,6 +205,13 @@ def main():
     log_handler.setFormatter(formatter)
     logger.addHandler(log_handler)
 
+    # Job metrics go to the same log as bare JSON lines
+    metrics_logger.setLevel(logging.INFO)
+    metrics_logger.propagate = False
+    metrics_handler = logging.StreamHandler(log_handler.stream)
+    metrics_handler.setFormatter(logging.Formatter("%(message)s"))
+    metrics_logger.addHandler(metrics_handler)
+
     if args.daemonize:
         logger.info('Starting')
         daemon_context = daemon.DaemonContext(
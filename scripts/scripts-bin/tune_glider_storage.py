@@ -0,0 +1,180 @@
+#!/usr/bin/python
+
+# tune_glider_storage.py - Writes the profiles of sample glider binary
+# data files with a grid of compression levels, shuffle filters and chunk
+# sizes, and writes the storage policy that makes the smallest files.
+#
+# Save the policy as storage_policy.json in the glider directory of the
+# configuration path given to create_glider_netcdf.py and
+# gdam_netcdf_subscriber.py to use it.
+#
+# By: Michael Lindemuth <mlindemu@usf.edu>
+# University of South Florida
+# College of Marine Science
+# Ocean Technology Group
+
+import argparse
+import json
+import shutil
+import sys
+import tempfile
+
+from glider_netcdf_writer.processing import find_segments
+from glider_netcdf_writer.tuning import (
+    DEFAULT_COMP_LEVELS,
+    DEFAULT_SHUFFLES,
+    DEFAULT_CHUNKSIZES,
+    create_storage_grid,
+    create_storage_policy,
+    find_tunable_keys,
+    sample_profiles,
+    tune_storage
+)
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Finds the compression level, shuffle filter and '
+                    'chunk size of each variable that make the smallest '
+                    'NetCDF files for sample glider binary data files.'
+    )
+
+    parser.add_argument(
+        'sample_paths',
+        nargs='+',
+        help='Flight and science files, directories or globs of them.  '
+             'Files are paired by name.'
+    )
+
+    parser.add_argument(
+        '-o', '--output',
+        help='Path of the storage policy JSON file.  Use - to print it.  '
+             'Default: ./storage_policy.json',
+        default='./storage_policy.json'
+    )
+
+    parser.add_argument(
+        '-p', '--profiles',
+        type=int,
+        help='Number of sample profiles to write, spread evenly over the '
+             'profiles of the sample files.  Default: 5',
+        default=5
+    )
+
+    parser.add_argument(
+        '-l', '--comp_levels',
+        type=int,
+        nargs='+',
+        help='Compression levels to try.  Default: %s' % (
+            ' '.join(str(level) for level in DEFAULT_COMP_LEVELS)
+        ),
+        default=list(DEFAULT_COMP_LEVELS)
+    )
+
+    parser.add_argument(
+        '-c', '--chunksizes',
+        type=int,
+        nargs='+',
+        help='Rows per chunk to try.  Default: %s' % (
+            ' '.join(str(chunks) for chunks in DEFAULT_CHUNKSIZES)
+        ),
+        default=list(DEFAULT_CHUNKSIZES)
+    )
+
+    parser.add_argument(
+        '--tolerance',
+        type=int,
+        help='Choose the fastest settings to write and read of those '
+             'within this many bytes per profile of the smallest files.  '
+             'Default: 100',
+        default=100
+    )
+
+    parser.add_argument(
+        '-t', '--time',
+        help="Set time parameter to use for profile recognition",
+        default="timestamp"
+    )
+
+    parser.add_argument(
+        '-d', '--depth',
+        help="Set depth parameter to use for profile recognition",
+        default="m_depth-m"
+    )
+
+    return parser
+
+
+def main():
+    parser = create_arg_parser()
+    args = parser.parse_args()
+
+    segments = []
+    for sample_path in args.sample_paths:
+        for mode in ('rt', 'delayed'):
+            for segment in find_segments(sample_path, mode):
+                if segment not in segments:
+                    segments.append(segment)
+    if len(segments) == 0:
+        raise ValueError('No flight or science files in %s' % (
+            ' '.join(args.sample_paths)
+        ))
+
+    profiles = sample_profiles(segments, args.profiles, args.time, args.depth)
+    if len(profiles) == 0:
+        raise ValueError('No profiles found in the sample files')
+    keys = find_tunable_keys(profiles)
+    grid = create_storage_grid(
+        args.comp_levels, DEFAULT_SHUFFLES, args.chunksizes
+    )
+
+    def progress(key):
+        print >> sys.stderr, "Measuring %s" % key
+
+    print >> sys.stderr, "Writing %d variables of %d profiles %d ways" % (
+        len(keys), len(profiles), len(grid) + 1
+    )
+    work_path = tempfile.mkdtemp()
+    try:
+        results = tune_storage(
+            profiles, keys, grid, work_path, args.tolerance,
+            progress=progress
+        )
+    finally:
+        shutil.rmtree(work_path)
+
+    # Times are relative to the writer defaults
+    print >> sys.stderr, "%-24s %9s %7s %7s  %s" % (
+        'variable', 'saved KB', 'write', 'read', 'settings'
+    )
+    total_saved = 0
+    for name, (default, chosen) in results.items():
+        saved = default.size - chosen.size
+        total_saved += saved
+        print >> sys.stderr, "%-24s %9.1f %6.0f%% %6.0f%%  %s" % (
+            name,
+            saved / 1024.0,
+            100.0 * chosen.write_time / default.write_time,
+            100.0 * chosen.read_time / default.read_time,
+            json.dumps(chosen.storage, sort_keys=True)
+            if chosen.storage else 'default'
+        )
+    print >> sys.stderr, "%-24s %9.1f KB over %d profiles" % (
+        'total', total_saved / 1024.0, len(profiles)
+    )
+
+    policy = json.dumps(
+        create_storage_policy(results), indent=4, sort_keys=True,
+        separators=(',', ': ')
+    )
+    if args.output == '-':
+        print policy
+    else:
+        with open(args.output, 'w') as f:
+            f.write(policy + '\n')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -10,9 +10,7 @@ setup(
     scripts=[
         'scripts/scripts-bin/check_glider_netcdf.py',
         'scripts/scripts-bin/create_glider_netcdf.py',
-        'scripts/scripts-bin/gdam_netcdf_subscriber.py'
-    ],
-    data_files=[
-        ('etc', ['scripts/etc/glider_DAC-2.0.json'])
+        'scripts/scripts-bin/gdam_netcdf_subscriber.py',
+        'scripts/scripts-bin/tune_glider_storage.py'
     ]
 )
@@ -7,12 +7,82 @@ from glider_binary_data_reader import (
 
 import os
 import json
+import pickle
+import shutil
+import sqlite3
+import tempfile
+import time
+from argparse import Namespace
+
+import numpy as np
+from netCDF4 import default_fillvals as NC_FILL_VALUES
 
 from glider_netcdf_writer import (
-    open_glider_netcdf
+    open_glider_netcdf,
+    load_datatype_registry,
+    compile_transforms,
+    find_least_significant_digit,
+    DEFAULT_GLIDER_BASE,
+    GLIDER_QC
+)
+from glider_netcdf_writer.processing import (
+    fill_table_gps,
+    find_gps_indices,
+    find_profile_slices,
+    find_segments,
+    get_header_template,
+    plan_uv_fills,
+    read_attrs
+)
+from glider_netcdf_writer import qartod
+from glider_netcdf_writer.subscriber import (
+    GliderJobQueue,
+    SubscriberMetrics
+)
+from glider_netcdf_writer.tuning import (
+    Measurement,
+    choose_storage,
+    create_storage_policy
+)
+from glider_netcdf_writer.checks import (
+    DEFAULT_STANDARD_PATH,
+    ValidationError,
+    check_file,
+    check_files,
+    load_requirements
 )
 
 
+class FakeResult(object):
+    def __init__(self, error):
+        self.error = error
+
+    def ready(self):
+        return True
+
+    def get(self):
+        if self.error is not None:
+            raise self.error
+        return {
+            'profiles': 1, 'started': time.time(), 'derived_errors': []
+        }
+
+
+class FakePool(object):
+    """ Records the flight files handed to it and fails each file in
+    failures once with its error.
+    """
+
+    def __init__(self):
+        self.flight_files = []
+        self.failures = {}
+
+    def apply_async(self, function, args):
+        flight_file = args[0]['flight_file']
+        self.flight_files.append(flight_file)
+        return FakeResult(self.failures.pop(flight_file, None))
+
+
 class TestMergedGliderDataReader(unittest.TestCase):
 
     def setUp(self):
@@ -53,6 +123,73 @@ class TestMergedGliderDataReader(unittest.TestCase):
             glider_nc.set_global_attributes(self.global_attributes)
         self.assertTrue(os.path.isfile(self.test_path))
 
+    def test_diskless(self):
+        diskless_path = './nc_diskless_test.nc'
+        with open_glider_netcdf(diskless_path, 'w',
+                                DISKLESS=True) as glider_nc:
+            glider_nc.set_global_attributes(self.global_attributes)
+            glider_nc.set_segment_id(3)
+            self.assertFalse(os.path.isfile(diskless_path))
+        self.assertTrue(os.path.isfile(diskless_path))
+        self.assertIsNone(glider_nc.temp_path)
+
+        with open_glider_netcdf(diskless_path, 'a',
+                                DISKLESS=True) as glider_nc:
+            self.assertEqual(glider_nc.get_scalar('segment_id'), 3)
+        os.remove(diskless_path)
+
+    def test_check_files(self):
+        requirements, standard_hash = load_requirements(
+            DEFAULT_STANDARD_PATH
+        )
+        check_path = './nc_check_test.nc'
+        with open_glider_netcdf(check_path, 'w') as glider_nc:
+            glider_nc.set_global_attributes(self.global_attributes)
+            glider_nc.set_platform(self.deployment['platform'])
+            glider_nc.set_instruments(self.instruments)
+
+        result = check_file(check_path, requirements)
+        self.assertEqual(result['tests']['test_platform_attributes'], [])
+        self.assertEqual(
+            result['errors'],
+            sum(len(errors) for errors in result['tests'].values())
+        )
+
+        cache_path = './nc_check_cache.json'
+        for cached in (False, True):
+            results = check_files(
+                [check_path], requirements, standard_hash,
+                cache_path=cache_path
+            )
+            self.assertEqual(results[0]['cached'], cached)
+            self.assertEqual(results[0]['errors'], result['errors'])
+        os.remove(cache_path)
+        os.remove(check_path)
+
+    def test_validate(self):
+        validate_path = './nc_validate_test.nc'
+        with open_glider_netcdf(validate_path, 'w',
+                                VALIDATE='tag') as glider_nc:
+            glider_nc.set_platform(self.deployment['platform'])
+        errors = glider_nc.validation_results['test_global_attributes']
+        self.assertGreater(len(errors), 0)
+
+        with open_glider_netcdf(validate_path, 'a') as glider_nc:
+            self.assertIn(
+                errors[0], glider_nc.nc.getncattr('validation_errors')
+            )
+
+        with self.assertRaises(ValidationError) as raised:
+            with open_glider_netcdf(validate_path, 'w',
+                                    VALIDATE='raise') as glider_nc:
+                glider_nc.set_platform(self.deployment['platform'])
+        self.assertFalse(os.path.isfile(validate_path))
+
+        # Worker processes send the error back pickled
+        error = pickle.loads(pickle.dumps(raised.exception))
+        self.assertEqual(str(error), str(raised.exception))
+        self.assertEqual(error.results, raised.exception.results)
+
     def test_set_trajectory_id(self):
         with open_glider_netcdf(self.test_path, self.mode) as glider_nc:
             glider_nc.set_trajectory_id(
@@ -96,6 +233,497 @@ class TestMergedGliderDataReader(unittest.TestCase):
             nc = glider_nc.nc
             self.assertIn('instrument_ctd', nc.variables)
 
+    def test_datatype_registry(self):
+        registry = load_datatype_registry(DEFAULT_GLIDER_BASE)
+        self.assertIs(registry, load_datatype_registry(DEFAULT_GLIDER_BASE))
+        self.assertIn('m_depth-m', registry.global_bound_keys)
+        self.assertIn('timestamp', registry.time_keys)
+        self.assertNotIn('profile_id', registry.status_flag_keys)
+
+        status_flag_attrs = dict(
+            registry.datatypes['m_depth-m']['status_flag']['attrs']
+        )
+        registry_path = './nc_registry_test.nc'
+        with open_glider_netcdf(registry_path, 'w') as glider_nc:
+            self.assertIs(glider_nc.datatypes, registry.datatypes)
+            glider_nc.check_datatype_exists('timestamp')
+            glider_nc.check_datatype_exists('m_depth-m')
+        os.remove(registry_path)
+        self.assertEqual(
+            registry.datatypes['m_depth-m']['status_flag']['attrs'],
+            status_flag_attrs
+        )
+        with self.assertRaises(TypeError):
+            registry.datatypes['m_depth-m']['attrs']['units'] = 'ft'
+
+    def test_read_attrs(self):
+        attrs = read_attrs('./example_config', 'usf-bass')
+        self.assertIs(attrs, read_attrs('./example_config', 'usf-bass'))
+        self.assertEqual(attrs['global']['sea_name'], 'Gulf of Mexico')
+        self.assertEqual(
+            attrs['global']['institution'],
+            self.global_attributes['institution']
+        )
+
+    def test_gps_lookup(self):
+        nan = float('nan')
+        # Rows of get_file_set_gps: time, latitude, longitude
+        interp_gps = np.array([
+            [1.0, 10.0, 20.0], [2.0, 11.0, 21.0],
+            [2.0, 12.0, 22.0], [3.0, 13.0, 23.0]
+        ])
+        # The first row of a repeated timestamp is used
+        self.assertEqual(
+            find_gps_indices(interp_gps, np.array([2.0, 3.0, 1.0])).tolist(),
+            [1, 3, 0]
+        )
+        for timestamps in ([2.5], [4.0]):
+            with self.assertRaises(IndexError):
+                find_gps_indices(interp_gps, np.array(timestamps))
+
+        # Only missing positions are filled
+        table = {
+            'timestamp': np.array([1.0, 2.0, 3.0]),
+            'm_gps_lat-lat': np.array([nan, 5.0, nan]),
+            'm_gps_lon-lon': np.array([nan, 6.0, nan])
+        }
+        fill_table_gps(table, interp_gps, 'timestamp', 'm_gps_')
+        self.assertEqual(table['m_gps_lat-lat'].tolist(), [10.0, 5.0, 13.0])
+        self.assertEqual(table['m_gps_lon-lon'].tolist(), [20.0, 6.0, 23.0])
+
+        # Tables without GPS columns get them
+        table = {'timestamp': np.array([2.0, 3.0])}
+        fill_table_gps(table, interp_gps, 'timestamp', 'm_gps_')
+        self.assertEqual(table['m_gps_lat-lat'].tolist(), [11.0, 13.0])
+        self.assertEqual(table['m_gps_lon-lon'].tolist(), [21.0, 23.0])
+
+    def test_find_segments(self):
+        batch_path = tempfile.mkdtemp()
+        names = [
+            'bass-02.ebd', 'bass-01.dbd', 'bass-01.ebd', 'bass-03.dbd',
+            'bass-01.sbd', 'bass-04.tbd', 'bass-05.txt'
+        ]
+        for name in names:
+            open(os.path.join(batch_path, name), 'w').close()
+
+        def paths(*segments):
+            return [
+                tuple(name and os.path.join(batch_path, name)
+                      for name in segment)
+                for segment in segments
+            ]
+
+        # Files are paired by prefix, and other modes are left out
+        self.assertEqual(
+            find_segments(batch_path, 'delayed'),
+            paths(('bass-01.dbd', 'bass-01.ebd'), (None, 'bass-02.ebd'),
+                  ('bass-03.dbd', None))
+        )
+        self.assertEqual(
+            find_segments(os.path.join(batch_path, 'bass-0[14].*'), 'rt'),
+            paths(('bass-01.sbd', None), (None, 'bass-04.tbd'))
+        )
+        shutil.rmtree(batch_path)
+
+    def test_profile_slices(self):
+        table = {'timestamp': np.arange(10.0)}
+        # Rows of find_profiles: time, depth, profile id
+        profiles = np.array([
+            [1.0, 0.0, 0], [3.0, 5.0, 0],
+            [4.0, 5.0, 1], [6.0, 0.0, 1],
+            [8.0, 5.0, 2]
+        ])
+        # Rows after the last profile time are not written
+        self.assertEqual(
+            find_profile_slices(table, profiles),
+            [(0, 0, 4), (1, 4, 7), (2, 7, 9)]
+        )
+
+    def test_plan_uv_fills(self):
+        nan = float('nan')
+        water_vx = np.array([nan, nan, nan, 0.1, nan, nan, 0.2, nan, nan])
+        table = {
+            'timestamp': np.arange(9.0),
+            'm_present_time-timestamp': np.arange(9.0),
+            'm_water_vx-m/s': water_vx,
+            'm_water_vy-m/s': water_vx * 2
+        }
+        slices = [(0, 0, 2), (1, 2, 4), (2, 4, 6), (3, 6, 7), (4, 7, 9)]
+        fills = plan_uv_fills(table, slices)
+
+        # Profiles before the first measurement take the first one, and
+        # later profiles without their own take the latest earlier one
+        self.assertEqual(
+            [fill and fill['m_water_vx-m/s'] for fill in fills],
+            [0.1, None, 0.1, None, 0.2]
+        )
+        self.assertEqual(fills[0]['time_uv'], 3.0)
+        self.assertEqual(fills[4]['m_water_vy-m/s'], 0.4)
+
+    def test_job_queue(self):
+        db = sqlite3.connect(':memory:')
+        pool = FakePool()
+        args = Namespace(max_attempts=3, retry_delay=0)
+        metrics = SubscriberMetrics(None)
+
+        def message(glider, name):
+            return {
+                'glider': glider,
+                'path': '/missing',
+                'flight_file': name + '.sbd',
+                'science_path': name + '.tbd'
+            }
+
+        queue = GliderJobQueue(db, pool, 2, args, metrics)
+        queue.add(message('bass', 'a'))
+        queue.add(message('bass', 'b'))
+        queue.add(message('gulf', 'c'))
+        # A repeated message for a pending job is merged into it
+        queue.add(message('bass', 'a'))
+        self.assertEqual(queue.size, 3)
+
+        # One job per glider runs at a time
+        queue.dispatch()
+        self.assertEqual(pool.flight_files, ['a.sbd', 'c.sbd'])
+
+        # Jobs left running by a crash are pending again on restart
+        queue = GliderJobQueue(db, pool, 2, args, metrics)
+        self.assertEqual(queue.size, 3)
+
+        # A failed job is retried before the next job of its glider
+        pool.failures['a.sbd'] = IOError('Unreadable a.sbd')
+        for i in range(3):
+            queue.dispatch()
+            queue.collect()
+        self.assertEqual(
+            pool.flight_files,
+            ['a.sbd', 'c.sbd', 'a.sbd', 'c.sbd', 'a.sbd', 'b.sbd']
+        )
+        self.assertEqual(queue.size, 0)
+        self.assertEqual(
+            db.execute(
+                "SELECT state, attempts FROM jobs ORDER BY id"
+            ).fetchall(),
+            [('done', 3), ('done', 1), ('done', 2)]
+        )
+
+        # Files that fail validation are not retried
+        data_path = tempfile.mkdtemp()
+        for name in ('d.sbd', 'd.tbd', 'e.sbd', 'e.tbd'):
+            open(os.path.join(data_path, name), 'w').close()
+        pool.failures['d.sbd'] = ValidationError('Invalid d.nc', {})
+        queue.add(dict(message('gulf', 'd'), path=data_path))
+        queue.add(dict(message('gulf', 'e'), path=data_path))
+        for i in range(3):
+            queue.dispatch()
+            queue.collect()
+        self.assertEqual(pool.flight_files[-2:], ['d.sbd', 'e.sbd'])
+        self.assertEqual(
+            db.execute(
+                "SELECT state, attempts FROM jobs WHERE id > 3 ORDER BY id"
+            ).fetchall(),
+            [('failed', 1), ('done', 1)]
+        )
+
+        # Resending the message of a failed job tries it again.  One of a
+        # done job is skipped while its files are unchanged.
+        queue.add(dict(message('gulf', 'd'), path=data_path))
+        queue.add(dict(message('gulf', 'e'), path=data_path))
+        self.assertEqual(queue.size, 1)
+        queue.dispatch()
+        self.assertEqual(pool.flight_files[-1:], ['d.sbd'])
+        shutil.rmtree(data_path)
+
+    def test_header_template(self):
+        attrs = read_attrs('./example_config', 'usf-bass')
+        keys = ('timestamp', 'm_depth-m')
+        template = get_header_template(attrs, keys)
+        self.assertIs(get_header_template(attrs, keys), template)
+
+        profile_path = './nc_template_test.nc'
+        with open_glider_netcdf(profile_path, 'w',
+                                TEMPLATE=template) as glider_nc:
+            glider_nc.set_segment_id(2)
+            glider_nc.set_profile_id(3)
+            glider_nc.insert_batch({
+                'timestamp': np.array([1.0, 2.0]),
+                'm_depth-m': np.array([1.0, 2.0])
+            })
+            nc = glider_nc.nc
+            self.assertEqual(nc.institution, attrs['global']['institution'])
+            self.assertEqual(len(nc.history.splitlines()), 1)
+            self.assertEqual(nc.variables['profile_id'].getValue(), 3)
+            self.assertEqual(len(nc.variables['depth']), 2)
+        os.remove(profile_path)
+
+    def test_transforms(self):
+        with open(os.path.join(DEFAULT_GLIDER_BASE, 'datatypes.json')) as f:
+            datatypes = json.load(f)
+        datatypes['m_pitch-rad']['transform'] = {'scale': 2, 'offset': 1}
+        pitch_degrees = dict(datatypes['m_pitch-rad'], name='pitch_degrees')
+        pitch_degrees['transform'] = {
+            'function': 'degrees',
+            'inputs': ['m_pitch-rad']
+        }
+        datatypes['pitch_degrees-deg'] = pitch_degrees
+
+        transforms, product_keys = compile_transforms(datatypes)
+        self.assertEqual(product_keys, ('pitch_degrees-deg',))
+        self.assertEqual(transforms['m_pitch-rad'].scale, 2)
+
+        config_path = tempfile.mkdtemp()
+        with open(os.path.join(config_path, 'datatypes.json'), 'w') as f:
+            json.dump(datatypes, f)
+        transform_path = os.path.join(config_path, 'transform_test.nc')
+        with open_glider_netcdf(transform_path, 'w',
+                                config_path=config_path) as glider_nc:
+            glider_nc.insert_batch({
+                'timestamp': np.array([1.0, 2.0]),
+                'm_depth-m': np.array([1.0, 2.0]),
+                'm_pitch-rad': np.array([np.pi, float('nan')])
+            })
+            nc = glider_nc.nc
+            self.assertEqual(nc.variables['pitch'][0], 2 * np.pi + 1)
+            self.assertAlmostEqual(nc.variables['pitch_degrees'][0], 180.0)
+            self.assertTrue(nc.variables['pitch_degrees'][:].mask[1])
+        shutil.rmtree(config_path)
+
+    def test_qartod(self):
+        values = np.array([1.0, 1.0, 10.0, 1.0, 1.0, 1.0, 1.0])
+        self.assertEqual(
+            qartod.spike(values, None, 1.0, 5.0).tolist(),
+            [0, 3, 4, 3, 1, 1, 0]
+        )
+        self.assertEqual(
+            qartod.flat_line(values, None, 0.0, 2, 3).tolist(),
+            [1, 1, 1, 1, 1, 3, 4]
+        )
+
+        qartod_path = './nc_qartod_test.nc'
+        with open_glider_netcdf(qartod_path, 'w') as glider_nc:
+            glider_nc.insert_batch({
+                'timestamp': np.array([1.0, 2.0, 3.0]),
+                'm_depth-m': np.array([1.0, 2.0, 3.0]),
+                'sci_water_temp-degc': np.array([20.0, 50.0, float('nan')])
+            })
+        with open_glider_netcdf(qartod_path, 'a') as glider_nc:
+            flags = glider_nc.nc.variables['temperature_qc'][:]
+            self.assertEqual(
+                flags[:2].tolist(),
+                [GLIDER_QC['good_data'], GLIDER_QC['bad_data']]
+            )
+            self.assertTrue(flags.mask[2])
+            glider_nc.nc.variables['temperature_qc'][0] = (
+                GLIDER_QC['probably_good_data']
+            )
+
+        # Appended rows are tested without testing earlier rows again
+        with open_glider_netcdf(qartod_path, 'a') as glider_nc:
+            glider_nc.insert_batch({
+                'timestamp': np.array([4.0]),
+                'm_depth-m': np.array([4.0]),
+                'sci_water_temp-degc': np.array([60.0])
+            })
+        with open_glider_netcdf(qartod_path, 'a') as glider_nc:
+            flags = glider_nc.nc.variables['temperature_qc'][:]
+            self.assertEqual(
+                flags[[0, 3]].tolist(),
+                [GLIDER_QC['probably_good_data'], GLIDER_QC['bad_data']]
+            )
+        os.remove(qartod_path)
+
+        self.assertEqual(qartod.context_size({'gross_range': {}}), 0)
+        self.assertEqual(qartod.context_size({
+            'spike': {},
+            'flat_line': {'suspect_count': 2, 'fail_count': 3}
+        }), 3)
+
+    def test_storage(self):
+        storage_path = './nc_storage_test.nc'
+        with open_glider_netcdf(storage_path, 'w',
+                                STORAGE={'chunksizes': 16,
+                                         'fletcher32': True},
+                                QC_STORAGE={'chunksizes': 64}) as glider_nc:
+            glider_nc.insert_batch({
+                'timestamp': np.array([1.0, 2.0]),
+                'm_depth-m': np.array([1.0, 2.0])
+            })
+            nc = glider_nc.nc
+            self.assertEqual(nc.variables['depth'].chunking(), [16])
+            self.assertTrue(nc.variables['depth'].filters()['fletcher32'])
+            self.assertEqual(nc.variables['depth_qc'].chunking(), [64])
+
+            desc = dict(glider_nc.datatypes['m_depth-m'])
+            desc['storage'] = {'chunksizes': 128}
+            self.assertEqual(glider_nc.get_storage(desc)['chunksizes'], 128)
+
+        storage_policy = {
+            'depth': {'complevel': 6},
+            'depth_qc': {'shuffle': True}
+        }
+        with open_glider_netcdf(storage_path, 'w', COMP_LEVEL=2,
+                                STORAGE_POLICY=storage_policy) as glider_nc:
+            glider_nc.insert_batch({
+                'timestamp': np.array([1.0, 2.0]),
+                'm_depth-m': np.array([1.0, 2.0])
+            })
+            nc = glider_nc.nc
+            self.assertEqual(nc.variables['depth'].filters()['complevel'], 6)
+            self.assertTrue(nc.variables['depth_qc'].filters()['shuffle'])
+            self.assertEqual(nc.variables['time'].filters()['complevel'], 2)
+        os.remove(storage_path)
+
+    def test_choose_storage(self):
+        default = Measurement(None, 1000, 1.0, 1.0)
+        small = Measurement({'complevel': 9}, 900, 2.0, 1.0)
+        fast = Measurement({'complevel': 4}, 950, 1.0, 1.0)
+        self.assertIs(choose_storage(default, [small, fast], 50), fast)
+        self.assertIs(choose_storage(default, [small, fast], 10), small)
+        self.assertIs(choose_storage(default, [small, fast], 100), default)
+
+        results = {
+            'depth': (default, small),
+            'temperature': (default, default)
+        }
+        self.assertEqual(
+            create_storage_policy(results), {'depth': {'complevel': 9}}
+        )
+
+    def test_least_significant_digit(self):
+        self.assertEqual(
+            find_least_significant_digit({'resolution': '0.001'}), 3
+        )
+        self.assertEqual(
+            find_least_significant_digit(
+                {'resolution': '0.01 m', 'precision': 0.0005}
+            ), 4
+        )
+        self.assertEqual(
+            find_least_significant_digit({'precision': '10 m'}), -1
+        )
+        self.assertIsNone(find_least_significant_digit({'resolution': ' '}))
+
+        quantize_path = './nc_quantize_test.nc'
+        with open_glider_netcdf(quantize_path, 'w',
+                                STORAGE={'least_significant_digit': 2}) \
+                as glider_nc:
+            glider_nc.insert_batch({
+                'timestamp': np.array([1.123456, 2.123456]),
+                'm_depth-m': np.array([1.123456, 2.123456])
+            })
+            nc = glider_nc.nc
+            depth = nc.variables['depth']
+            self.assertEqual(depth.least_significant_digit, 2)
+            self.assertTrue(np.all(np.abs(depth[:] - [1.123456, 2.123456])
+                                   < 0.005))
+            self.assertNotEqual(depth[0], 1.123456)
+            # The time coordinate is always stored exactly
+            self.assertEqual(nc.variables['time'][0], 1.123456)
+        os.remove(quantize_path)
+
+    def test_array_qaqc(self):
+        values = np.array([1.0, NC_FILL_VALUES['f8'], float('nan'), 2.0])
+        with open_glider_netcdf(self.test_path, self.mode) as glider_nc:
+            flags = glider_nc.perform_array_qaqc('m_depth-m', values)
+            self.assertEqual(
+                flags.tolist(),
+                [GLIDER_QC['no_qc_performed'], GLIDER_QC['missing_value'],
+                 GLIDER_QC['missing_value'], GLIDER_QC['no_qc_performed']]
+            )
+
+            glider_nc.qaqc_methods['m_depth-m'] = (
+                lambda array: np.where(array > 1.5, 4, 1)
+            )
+            flags = glider_nc.perform_array_qaqc(
+                'm_depth-m', np.array([1.0, 2.0])
+            )
+            self.assertEqual(flags.tolist(), [1, 4])
+
+    def test_insert_batch(self):
+        columns = {
+            'timestamp': np.array([1.0, 2.0, 3.0]),
+            'm_depth-m': np.array([4.0, float('nan'), 6.0]),
+            'unknown_type-nodim': np.array([7.0, 8.0, 9.0])
+        }
+        with open_glider_netcdf(self.test_path, self.mode) as glider_nc:
+            start_index = glider_nc.stream_index
+            glider_nc.insert_batch(columns)
+            self.assertEqual(glider_nc.stream_index, start_index + 3)
+
+            nc = glider_nc.nc
+            depth = nc.variables['depth'][start_index:]
+            self.assertEqual(depth[0], 4.0)
+            self.assertTrue(depth.mask[1])
+            self.assertEqual(
+                nc.variables['depth_qc'][start_index + 2],
+                GLIDER_QC['no_qc_performed']
+            )
+
+    def test_calculate_derived(self):
+        derived_path = './nc_derived_test.nc'
+        with open_glider_netcdf(derived_path, 'w') as glider_nc:
+            glider_nc.insert_batch({
+                'timestamp': np.array([1.0, 2.0, 3.0]),
+                'm_depth-m': np.array([1.0, 2.0, 3.0]),
+                'sci_water_cond-s/m': np.array([4.0, 4.1, 4.2]),
+                'sci_water_temp-degc': np.array([20.0, 20.1, 20.2]),
+                'sci_water_pressure-bar': np.array([0.1, 0.2, 0.3]),
+                'm_gps_lat-lat': np.array([27.0, 27.0, 27.0]),
+                'm_gps_lon-lon': np.array([-82.0, -82.0, -82.0])
+            })
+            temperature = glider_nc.get_column('temperature')
+            self.assertIs(temperature, glider_nc.get_column('temperature'))
+
+            # Salinity is calculated first because density needs it
+            glider_nc.calculate_derived(['density'])
+            nc = glider_nc.nc
+            self.assertIn('salinity', nc.variables)
+            self.assertEqual(len(nc.variables['density']), 3)
+        os.remove(derived_path)
+
+    def test_running_statistics(self):
+        with open_glider_netcdf(self.test_path, self.mode) as glider_nc:
+            glider_nc.insert_batch({
+                'timestamp': np.array([10.0, 11.0]),
+                'm_depth-m': np.array([-5000.0, float('nan')])
+            })
+            glider_nc.stream_dict_insert({
+                'timestamp': 12.0,
+                'm_depth-m': 5000.0
+            })
+            statistics = glider_nc.get_running_statistics('depth')
+            self.assertEqual(statistics.minimum, -5000.0)
+            self.assertEqual(statistics.maximum, 5000.0)
+
+        with open_glider_netcdf(self.test_path, 'a') as glider_nc:
+            nc = glider_nc.nc
+            self.assertEqual(nc.geospatial_vertical_min, -5000.0)
+            self.assertEqual(nc.geospatial_vertical_max, 5000.0)
+            statistics = glider_nc.get_running_statistics('depth')
+            self.assertEqual(statistics.maximum, 5000.0)
+
+    def test_replaced_statistics(self):
+        stats_path = './nc_stats_test.nc'
+        with open_glider_netcdf(stats_path, 'w') as glider_nc:
+            glider_nc.set_array_value('timestamp', 0, 10.0)
+            glider_nc.set_array_value('m_depth-m', 0, 100.0)
+            glider_nc.set_array_value('m_depth-m', 0, 10.0)
+            statistics = glider_nc.get_running_statistics('depth')
+            self.assertEqual(statistics.maximum, 10.0)
+
+        with open_glider_netcdf(stats_path, 'a') as glider_nc:
+            nc = glider_nc.nc
+            self.assertEqual(nc.geospatial_vertical_max, 10.0)
+            self.assertNotIn(
+                'running_statistics', nc.variables['depth'].ncattrs()
+            )
+
+        # Variables created without writing values are summarized too
+        with open_glider_netcdf(stats_path, 'w') as glider_nc:
+            glider_nc.set_array_value('timestamp', 0, 10.0)
+            glider_nc.check_datatype_exists('m_depth-m')
+        os.remove(stats_path)
+
     def test_data_insert(self):
         flightReader = GliderBDReader(
             ['./test_data/usf-bass/usf-bass-2014-061-1-0.sbd']
@@ -109,6 +737,66 @@ class TestMergedGliderDataReader(unittest.TestCase):
             for line in reader:
                 glider_nc.stream_dict_insert(line)
 
+    def test_buffered_data_insert(self):
+        flightReader = GliderBDReader(
+            ['./test_data/usf-bass/usf-bass-2014-061-1-0.sbd']
+        )
+        scienceReader = GliderBDReader(
+            ['./test_data/usf-bass/usf-bass-2014-061-1-0.tbd']
+        )
+        reader = MergedGliderBDReader(flightReader, scienceReader)
+
+        with open_glider_netcdf(self.test_path, self.mode,
+                                BUFFER_ROWS=100) as glider_nc:
+            start_index = glider_nc.stream_index
+            count = 0
+            for line in reader:
+                glider_nc.stream_dict_insert(line)
+                count += 1
+            glider_nc.flush()
+            nc = glider_nc.nc
+            self.assertEqual(len(nc.variables['time']), start_index + count)
+            self.assertEqual(glider_nc.buffer_len, 0)
+
+    def test_buffered_set_array_value(self):
+        set_path = './nc_set_test.nc'
+        with open_glider_netcdf(set_path, 'w',
+                                BUFFER_ROWS=100) as glider_nc:
+            for i in range(10):
+                glider_nc.stream_dict_insert({
+                    'timestamp': float(i), 'm_depth-m': 100.0
+                })
+            glider_nc.set_array_value('m_depth-m', 5, 7.0)
+            glider_nc.flush()
+            self.assertEqual(glider_nc.get_column('depth')[5], 7.0)
+        os.remove(set_path)
+
+    def test_flush_queue(self):
+        lines = [
+            {'timestamp': float(i), 'm_depth-m': float(i)}
+            for i in range(250)
+        ]
+        flush_path = './nc_flush_test.nc'
+        with open_glider_netcdf(flush_path, 'w', BUFFER_ROWS=100,
+                                FLUSH_QUEUE=1) as glider_nc:
+            for line in lines:
+                glider_nc.stream_dict_insert(line)
+            glider_nc.flush()
+            depth = glider_nc.get_column('depth')
+            self.assertEqual(depth.tolist(), range(250))
+            self.assertGreaterEqual(glider_nc.flush_wait_time, 0)
+
+        def fail(values):
+            raise ArithmeticError('QAQC failed')
+
+        with self.assertRaises(ArithmeticError):
+            with open_glider_netcdf(flush_path, 'w', BUFFER_ROWS=100,
+                                    FLUSH_QUEUE=1) as glider_nc:
+                glider_nc.qaqc_methods['m_depth-m'] = fail
+                for line in lines[:150]:
+                    glider_nc.stream_dict_insert(line)
+        os.remove(flush_path)
+
 
 if __name__ == '__main__':
     unittest.main()